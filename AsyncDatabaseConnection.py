@@ -0,0 +1,231 @@
+#!/usr/bin/python
+#
+
+'''
+Asynchronous access to the database, for asyncio code that must not block
+the event loop while it waits for the database.
+
+AsyncDatabaseConnection is the async counterpart of DatabaseConnection. It
+uses the same mapped classes from ModelClasses (the schema is still reflected
+once, through the synchronous DatabaseConnection, which is created here if
+needed). With SQLAlchemy >= 1.4 and an async driver installed (aiosqlite for
+SQLite, asyncpg for PostgreSQL) it opens a native async engine. Otherwise each
+session runs an ordinary Session in a worker thread of its own, behind the
+same awaitable interface, so the calling code does not change:
+
+	adb = AsyncDatabaseConnection('sqlite:///Stars.sqlite')
+	from ModelClasses import Star
+
+	async def ingest(names):
+		async with adb.session() as session:
+			for name in names:
+				data = await fetch_catalog(name)	# overlaps with the database calls
+				stars = await session.run_sync(lambda s: s.query(Star).filter(Star.name == name).all())
+				...
+			await session.commit()
+
+Sessions are transactional (nothing is written until commit()). Core
+statements can be passed to execute(); ORM queries are run with run_sync(),
+which calls a function with the synchronous session.
+'''
+
+import asyncio
+import functools
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from DatabaseConnection import DatabaseConnection
+
+try:
+	from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+except ImportError:
+	# SQLAlchemy < 1.4 has no async engine
+	create_async_engine = None
+
+# backend --> (async driver name, module to import)
+ASYNC_DRIVERS = {'sqlite': ('aiosqlite', 'aiosqlite'),
+                 'postgresql': ('asyncpg', 'asyncpg')}
+
+
+def async_connection_string(database_connection_string):
+	'''
+	Swap the driver of a connection string for the async one:
+	'sqlite:///Stars.sqlite' --> 'sqlite+aiosqlite:///Stars.sqlite'
+	'''
+	scheme, rest = database_connection_string.split(':', 1)
+	backend = scheme.split('+')[0]
+	if backend not in ASYNC_DRIVERS:
+		raise ValueError('There is no async driver for "{}" databases'.format(backend))
+	return '{}+{}:{}'.format(backend, ASYNC_DRIVERS[backend][0], rest)
+
+
+def native_async_available(database_connection_string):
+	'''
+	:return: True if SQLAlchemy and the installed drivers support a native async engine for this database
+	'''
+	if create_async_engine is None:
+		return False
+	backend = database_connection_string.split(':', 1)[0].split('+')[0]
+	if backend not in ASYNC_DRIVERS:
+		return False
+	try:
+		importlib.import_module(ASYNC_DRIVERS[backend][1])
+	except ImportError:
+		return False
+	return True
+
+
+class BufferedResult(object):
+	'''The rows of a statement executed by a ThreadedAsyncSession, read before leaving the worker thread.'''
+	def __init__(self, keys, rows, rowcount):
+		self._keys = keys
+		self.rows = rows
+		self.rowcount = rowcount
+
+	def keys(self):
+		return self._keys
+
+	def all(self):
+		return list(self.rows)
+
+	def first(self):
+		return self.rows[0] if len(self.rows) > 0 else None
+
+	def scalar(self):
+		return self.rows[0][0] if len(self.rows) > 0 else None
+
+	def scalars(self):
+		return BufferedResult(self._keys[:1], [row[0] for row in self.rows], self.rowcount)
+
+	def __iter__(self):
+		return iter(self.rows)
+
+
+class ThreadedAsyncSession(object):
+	'''
+	The parts of the AsyncSession interface used with this package, for SQLAlchemy versions
+	without native async support. Every call is run in the session's own worker thread,
+	so the connection it holds is only ever used from one thread.
+	'''
+	def __init__(self, sync_session):
+		self.sync_session = sync_session
+		self._executor = ThreadPoolExecutor(max_workers=1)
+
+	async def _run(self, function, *args, **kwargs):
+		loop = asyncio.get_event_loop()
+		return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+	async def run_sync(self, function, *args, **kwargs):
+		'''Call function(sync_session, *args, **kwargs) in the worker thread.'''
+		return await self._run(function, self.sync_session, *args, **kwargs)
+
+	async def execute(self, statement, params=None):
+		def _execute(session):
+			result = session.execute(statement, params)
+			if result.returns_rows:
+				return BufferedResult(list(result.keys()), result.fetchall(), result.rowcount)
+			return BufferedResult([], [], result.rowcount)
+		return await self.run_sync(_execute)
+
+	async def scalar(self, statement, params=None):
+		return (await self.execute(statement, params)).scalar()
+
+	async def get(self, cls, ident):
+		return await self.run_sync(lambda session: session.query(cls).get(ident))
+
+	def add(self, instance):
+		self.sync_session.add(instance)
+
+	def add_all(self, instances):
+		self.sync_session.add_all(instances)
+
+	async def delete(self, instance):
+		await self.run_sync(lambda session: session.delete(instance))
+
+	async def refresh(self, instance):
+		await self.run_sync(lambda session: session.refresh(instance))
+
+	async def flush(self):
+		await self.run_sync(lambda session: session.flush())
+
+	async def commit(self):
+		await self.run_sync(lambda session: session.commit())
+
+	async def rollback(self):
+		await self.run_sync(lambda session: session.rollback())
+
+	async def close(self):
+		await self.run_sync(lambda session: session.close())
+		self._executor.shutdown(wait=False)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+		await self.close()
+
+
+def _sqlite_fk_pragma(dbapi_con, connection_record):
+	cursor = dbapi_con.cursor()
+	cursor.execute('pragma foreign_keys=ON')
+	cursor.close()
+
+
+class AsyncDatabaseConnection(object):
+	'''This class defines an object that makes an asynchronous connection to a database.
+	   Like DatabaseConnection, it implements the singleton design pattern: the first
+	   call *requires* the (ordinary, synchronous) SQLAlchemy connection string, and
+	   every later call of
+
+	   adb = AsyncDatabaseConnection()
+
+	   returns the same object.
+
+	   adb.native tells whether a native async engine (adb.engine) is used, or sessions
+	   running in worker threads on the synchronous engine (adb.sync_engine).
+	'''
+	_singletons = dict()
+
+	def __new__(cls, database_connection_string=None, echo=False, **engine_options):
+		"""This overrides the object's usual creation mechanism."""
+
+		if not cls in cls._singletons:
+			assert database_connection_string is not None, "A database connection string must be specified!"
+			cls._singletons[cls] = object.__new__(cls)
+
+			me = cls._singletons[cls] # just for convenience (think "self")
+			me.database_connection_string = database_connection_string
+
+			# ModelClasses reflects the schema with the synchronous connection
+			try:
+				db = DatabaseConnection()
+			except AssertionError:
+				db = DatabaseConnection(database_connection_string, echo=echo)
+			me.sync_engine = db.engine
+
+			me.native = native_async_available(database_connection_string)
+			if me.native:
+				me.engine = create_async_engine(async_connection_string(database_connection_string),
+				                                echo=echo, **engine_options)
+				if me.engine.dialect.name == 'sqlite':
+					event.listen(me.engine.sync_engine, 'connect', _sqlite_fk_pragma)
+				me.Session = sessionmaker(bind=me.engine, class_=AsyncSession, expire_on_commit=False)
+			else:
+				me.engine = None
+				sync_sessionmaker = sessionmaker(bind=me.sync_engine, expire_on_commit=False)
+				me.Session = lambda: ThreadedAsyncSession(sync_sessionmaker())
+
+		return cls._singletons[cls]
+
+	def session(self):
+		'''
+		:return: a new session (use it with "async with")
+		'''
+		return self.Session()
+
+	async def dispose(self):
+		if self.native:
+			await self.engine.dispose()
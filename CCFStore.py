@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+"""
+Compressed, chunked storage for the full CCF grids behind the ccf table.
+
+Every CCF is a grid of cross-correlation values over temperature x metallicity
+x vsini x radial velocity. All the grids in a store share the same axes, which
+are saved in <directory>/axes.npz. Grids are appended in segments (one per
+call to add_many), and each segment is split into one compressed chunk per
+(temperature, metallicity) point:
+
+    <directory>/segment_0000/ids.npy               the CCF ids in this segment
+    <directory>/segment_0000/T012_Z003.npz         values for all of them at one
+                                                   temperature/metallicity, with
+                                                   shape (n_ccf, n_vsini, n_rv)
+
+so "all CCFs at T=6000 K, [Fe/H]=0" reads one small chunk per segment, and
+the peak / significance queries run over whole chunks at once with numpy.
+"""
+
+from __future__ import print_function
+
+import glob
+import os
+
+import numpy as np
+
+from ModelClasses import CCF, Observation
+
+
+# Fill in the store location here.
+store_directory = 'CCFStore'
+
+AXES = ('temperature', 'metal', 'vsini', 'rv')
+PEAK_DTYPE = np.dtype([('ccf_id', np.int64), ('value', np.float64), ('temperature', np.float64),
+                       ('metal', np.float64), ('vsini', np.float64), ('rv', np.float64)])
+
+
+class CCFStore():
+    _instances = dict()
+
+    def __init__(self, directory=None, temperature=None, metal=None, vsini=None, rv=None):
+        """
+        Open a CCF store, creating it if the axes are given and the store does not exist yet.
+        :param directory: the directory holding the store (defaults to the module-level store_directory)
+        :param temperature, metal, vsini, rv: the grid axes (only needed when creating a store)
+        """
+        self.directory = store_directory if directory is None else directory
+        axes_file = os.path.join(self.directory, 'axes.npz')
+        if not os.path.exists(axes_file):
+            if any(a is None for a in (temperature, metal, vsini, rv)):
+                raise ValueError('Must give the grid axes to create a new CCF store at {}!'.format(self.directory))
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            np.savez(axes_file, temperature=temperature, metal=metal, vsini=vsini, rv=rv)
+        axes = np.load(axes_file)
+        self.axes = dict((name, axes[name]) for name in AXES)
+        self.shape = tuple(len(self.axes[name]) for name in AXES)
+        self.refresh()
+
+    @classmethod
+    def default(cls):
+        """
+        :return: a shared store for the module-level store_directory
+        """
+        if store_directory not in cls._instances:
+            cls._instances[store_directory] = cls(store_directory)
+        return cls._instances[store_directory]
+
+    def refresh(self):
+        """
+        Re-read the list of segments and the CCF ids they hold.
+        """
+        self.segments = sorted(os.path.dirname(f) for f in glob.glob(os.path.join(self.directory, 'segment_*', 'ids.npy')))
+        self._ids = [np.load(os.path.join(segment, 'ids.npy')) for segment in self.segments]
+        self._location = dict()
+        for n, ids in enumerate(self._ids):
+            for i, ccf_id in enumerate(ids):
+                self._location[int(ccf_id)] = (n, i)
+
+    def __contains__(self, ccf_id):
+        return ccf_id in self._location
+
+    def __len__(self):
+        return len(self._location)
+
+    def _index(self, axis, value):
+        """
+        :return: the index of the given value on a grid axis
+        """
+        idx = np.flatnonzero(np.isclose(self.axes[axis], value))
+        if len(idx) == 0:
+            raise ValueError('{} = {} is not on the CCF grid ({})'.format(axis, value, self.axes[axis]))
+        return idx[0]
+
+    @staticmethod
+    def _chunk_name(i_temp, i_metal):
+        return 'T{:03d}_Z{:03d}.npz'.format(i_temp, i_metal)
+
+    def _read_chunk(self, segment, i_temp, i_metal):
+        with np.load(os.path.join(segment, self._chunk_name(i_temp, i_metal))) as chunk:
+            return chunk['ccf']
+
+    def add_many(self, ccfs):
+        """
+        Append CCF grids to the store as a new segment. CCFs that are already stored are skipped.
+        :param ccfs: iterable of (ccf_id, grid) tuples, with grid shaped (n_temperature, n_metal, n_vsini, n_rv)
+        :return: the number of CCFs added
+        """
+        ids, grids = [], []
+        for ccf_id, grid in ccfs:
+            if ccf_id in self._location:
+                continue
+            grid = np.asarray(grid, dtype=np.float32)
+            if grid.shape != self.shape:
+                raise ValueError('CCF {} has shape {}, but the store grid is {}'.format(ccf_id, grid.shape, self.shape))
+            ids.append(ccf_id)
+            grids.append(grid)
+        if len(ids) == 0:
+            return 0
+
+        grids = np.stack(grids)
+        n_segments = len(glob.glob(os.path.join(self.directory, 'segment_*')))
+        segment = os.path.join(self.directory, 'segment_{:04d}'.format(n_segments))
+        os.makedirs(segment)
+        for i_temp in range(self.shape[0]):
+            for i_metal in range(self.shape[1]):
+                np.savez_compressed(os.path.join(segment, self._chunk_name(i_temp, i_metal)),
+                                    ccf=grids[:, i_temp, i_metal])
+        # The id file is written last, so an interrupted write never shows up as a segment
+        np.save(os.path.join(segment, 'ids.npy'), np.array(ids, dtype=np.int64))
+        self.refresh()
+        return len(ids)
+
+    def pack(self, session, reader, chunk_size=500):
+        """
+        Copy the grids of every CCF row that is not in the store yet.
+        :param session: a sqlalchemy session instance
+        :param reader: function taking the CCF directory and returning its grid,
+                       shaped (n_temperature, n_metal, n_vsini, n_rv) on the store axes
+        :param chunk_size: the number of CCFs per segment
+        :return: the number of CCFs added
+        """
+        pending = []
+        n_added = 0
+        for ccf_id, directory in session.query(CCF.id, CCF.directory).order_by(CCF.id):
+            if ccf_id in self._location or directory is None:
+                continue
+            pending.append((ccf_id, reader(directory)))
+            if len(pending) == chunk_size:
+                n_added += self.add_many(pending)
+                pending = []
+        return n_added + self.add_many(pending)
+
+    def get(self, ccf_id):
+        """
+        :return: the full (n_temperature, n_metal, n_vsini, n_rv) grid of one CCF
+        """
+        try:
+            n, i = self._location[ccf_id]
+        except KeyError:
+            raise KeyError('CCF {} is not in the CCF store at {}'.format(ccf_id, self.directory))
+        grid = np.empty(self.shape, dtype=np.float32)
+        for i_temp in range(self.shape[0]):
+            for i_metal in range(self.shape[1]):
+                grid[i_temp, i_metal] = self._read_chunk(self.segments[n], i_temp, i_metal)[i]
+        return grid
+
+    def _select(self, ccf_ids):
+        """
+        :return: list of (segment number, row indices into the segment, the matching ccf ids)
+        """
+        if ccf_ids is None:
+            return [(n, np.arange(len(ids)), ids) for n, ids in enumerate(self._ids)]
+        wanted = np.asarray(list(ccf_ids), dtype=np.int64)
+        selection = []
+        for n, ids in enumerate(self._ids):
+            rows = np.flatnonzero(np.in1d(ids, wanted))
+            if len(rows) > 0:
+                selection.append((n, rows, ids[rows]))
+        return selection
+
+    def slice(self, temperature, metal, ccf_ids=None):
+        """
+        Get the vsini x rv plane at one temperature and metallicity for many CCFs.
+        :param temperature: the grid temperature
+        :param metal: the grid metallicity
+        :param ccf_ids: the CCF ids to return (default: every stored CCF)
+        :return: (ccf ids, array of shape (n_ccf, n_vsini, n_rv))
+        """
+        i_temp, i_metal = self._index('temperature', temperature), self._index('metal', metal)
+        ids, planes = [np.zeros(0, dtype=np.int64)], [np.zeros((0,) + self.shape[2:], dtype=np.float32)]
+        for n, rows, segment_ids in self._select(ccf_ids):
+            ids.append(segment_ids)
+            planes.append(self._read_chunk(self.segments[n], i_temp, i_metal)[rows])
+        return np.concatenate(ids), np.concatenate(planes)
+
+    def slice_observations(self, session, observation_ids, temperature, metal):
+        """
+        Same as slice, but selecting the CCFs by observation id.
+        :return: (observation ids, array of shape (n_observations, n_vsini, n_rv)) for the observations with a stored CCF
+        """
+        observation_ids = list(observation_ids)
+        obs_to_ccf = dict()
+        for i in range(0, len(observation_ids), 500):
+            obs_to_ccf.update(session.query(Observation.id, Observation.ccf_id)
+                              .filter(Observation.id.in_(observation_ids[i:i + 500])).all())
+        ccf_ids, planes = self.slice(temperature, metal, ccf_ids=[c for c in obs_to_ccf.values() if c is not None])
+        row = dict((c, i) for i, c in enumerate(ccf_ids))
+        obs_ids = [o for o in observation_ids if obs_to_ccf.get(o) in row]
+        return np.array(obs_ids, dtype=np.int64), planes[[row[obs_to_ccf[o]] for o in obs_ids]]
+
+    def _reduce(self, ccf_ids, statistic, temperature=None, metal=None):
+        """
+        Find the grid point that maximizes statistic(plane) for every CCF, reading one chunk at a time.
+        :param statistic: function mapping an (n_ccf, n_vsini, n_rv) array to the same shape
+        :return: structured array with PEAK_DTYPE
+        """
+        temps = range(self.shape[0]) if temperature is None else [self._index('temperature', temperature)]
+        metals = range(self.shape[1]) if metal is None else [self._index('metal', metal)]
+        output = []
+        for n, rows, segment_ids in self._select(ccf_ids):
+            best = np.full(len(rows), -np.inf)
+            best_idx = np.zeros((len(rows), 4), dtype=np.int64)
+            for i_temp in temps:
+                for i_metal in metals:
+                    values = statistic(self._read_chunk(self.segments[n], i_temp, i_metal)[rows])
+                    flat = values.reshape(len(rows), -1)
+                    arg = np.argmax(np.where(np.isnan(flat), -np.inf, flat), axis=1)
+                    peak = flat[np.arange(len(rows)), arg]
+                    better = peak > best
+                    best[better] = peak[better]
+                    best_idx[better, 0] = i_temp
+                    best_idx[better, 1] = i_metal
+                    best_idx[better, 2:] = np.column_stack(np.unravel_index(arg[better], self.shape[2:]))
+            out = np.zeros(len(rows), dtype=PEAK_DTYPE)
+            out['ccf_id'] = segment_ids
+            out['value'] = best
+            for k, axis in enumerate(AXES):
+                out[axis] = self.axes[axis][best_idx[:, k]]
+            output.append(out)
+        return np.concatenate(output) if len(output) > 0 else np.zeros(0, dtype=PEAK_DTYPE)
+
+    def peaks(self, ccf_ids=None, temperature=None, metal=None):
+        """
+        Find the peak of every CCF, optionally restricted to one temperature and/or metallicity.
+        :return: structured array with fields ccf_id, value, temperature, metal, vsini, rv
+        """
+        return self._reduce(ccf_ids, lambda plane: plane, temperature=temperature, metal=metal)
+
+    def significance(self, ccf_ids=None, temperature=None, metal=None):
+        """
+        Find the most significant peak of every CCF. The significance of a point is its height above
+        the mean of its CCF along the radial velocity axis, in units of the standard deviation along that axis.
+        :return: structured array with fields ccf_id, value (the significance), temperature, metal, vsini, rv
+        """
+        def sigma(plane):
+            mean = np.nanmean(plane, axis=-1, keepdims=True)
+            std = np.nanstd(plane, axis=-1, keepdims=True)
+            return (plane - mean) / np.where(std > 0, std, np.nan)
+        return self._reduce(ccf_ids, sigma, temperature=temperature, metal=metal)
+
+    def top_k(self, k, ccf_ids=None, temperature=None, metal=None, by='value'):
+        """
+        :param k: the number of CCFs to return
+        :param by: 'value' to rank by peak height, or 'significance' to rank by peak significance
+        :return: the k CCFs with the highest peaks, as a structured array sorted from highest down
+        """
+        if by == 'value':
+            peaks = self.peaks(ccf_ids, temperature=temperature, metal=metal)
+        elif by == 'significance':
+            peaks = self.significance(ccf_ids, temperature=temperature, metal=metal)
+        else:
+            raise ValueError('Unknown ranking "{}". Use "value" or "significance"'.format(by))
+        if len(peaks) > k:
+            peaks = peaks[np.argpartition(-peaks['value'], k - 1)[:k]]
+        return np.sort(peaks, order='value')[::-1]
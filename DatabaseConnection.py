@@ -53,10 +53,15 @@ class DatabaseConnection(object):
 	   db = DatabaseConnection()
 	   
 	   the same object is returned and contains the connection information.
+
+	   Set echo=True on the first call to log every SQL statement. For timings
+	   and statement counts, attach an Instrumentation.Profiler to the engine.
+	   Any other keyword arguments of the first call (e.g. poolclass, pool_size)
+	   are passed on to create_engine.
 	'''
 	_singletons = dict()
 	
-	def __new__(cls, database_connection_string=None):
+	def __new__(cls, database_connection_string=None, echo=False, **engine_options):
 		"""This overrides the object's usual creation mechanism."""
 
 		if not cls in cls._singletons:
@@ -70,8 +75,8 @@ class DatabaseConnection(object):
 			
 			me.database_connection_string = database_connection_string
 			
-			# change 'echo' to print each SQL query (for debugging/optimizing/the curious)
-			me.engine = create_engine(me.database_connection_string, echo=False)	
+			# 'echo' prints each SQL query (for debugging/optimizing/the curious)
+			me.engine = create_engine(me.database_connection_string, echo=echo, **engine_options)
 
 			me.metadata = MetaData()
 			me.metadata.bind = me.engine
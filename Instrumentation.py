@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+"""
+Profiling hooks for the database and the ingest scripts.
+
+A Profiler attached to an engine records, for every distinct SQL statement,
+how many times it was executed, the number of rows it affected (as reported
+by the driver, so usually only for INSERT/UPDATE/DELETE) and a histogram of
+its latency. It also counts the ORM instances loaded per mapped class.
+
+Blocks of code (ingest stages, remote catalog queries) are timed with the
+stage() context manager or the timed() decorator, which also record how
+many statements were executed inside them, so that N+1 query patterns
+stand out.
+
+Usage:
+    from Instrumentation import profiler
+
+    profiler.attach(engine)
+    with profiler.stage('make_star_systems'):
+        make_star_systems(session)
+    profiler.write('metrics.json')
+    print(profiler.summary())
+"""
+
+from __future__ import print_function
+
+import contextlib
+import functools
+import json
+import re
+import threading
+import timeit
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper
+
+
+# Upper edges of the latency histogram bins, in seconds. The last bin catches everything slower.
+LATENCY_BINS = np.array([1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1.0, 3.0, 10.0, np.inf])
+
+
+class _Stats():
+    """
+    Accumulated timings for one statement or one stage.
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.statements = 0
+        self.histogram = np.zeros(len(LATENCY_BINS), dtype=np.int64)
+
+    def add(self, seconds, rows=0, statements=0):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rows += max(rows, 0)
+        self.statements += statements
+        self.histogram[np.searchsorted(LATENCY_BINS, seconds)] += 1
+
+    def as_dict(self):
+        return {'count': self.count,
+                'seconds': self.seconds,
+                'mean_seconds': self.seconds / self.count if self.count > 0 else None,
+                'max_seconds': self.max_seconds,
+                'rows': self.rows,
+                'statements': self.statements,
+                'histogram': self.histogram.tolist()}
+
+
+class Profiler():
+    def __init__(self):
+        self.statements = dict()
+        self.stages = dict()
+        self.loaded = dict()
+        self.n_statements = 0
+        self.sql_seconds = 0.0
+        self._engines = []
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        """
+        Start recording every statement executed through the given engine.
+        """
+        if engine in self._engines:
+            return
+        if len(self._engines) == 0:
+            event.listen(Mapper, 'load', self._on_load)
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._on_error)
+        self._engines.append(engine)
+
+    def detach(self, engine=None):
+        """
+        Stop recording statements for the given engine (or for every engine if None).
+        """
+        for e in list(self._engines) if engine is None else [engine]:
+            event.remove(e, 'before_cursor_execute', self._before_execute)
+            event.remove(e, 'after_cursor_execute', self._after_execute)
+            event.remove(e, 'handle_error', self._on_error)
+            self._engines.remove(e)
+            if len(self._engines) == 0:
+                event.remove(Mapper, 'load', self._on_load)
+
+    def reset(self):
+        with self._lock:
+            self.statements = dict()
+            self.stages = dict()
+            self.loaded = dict()
+            self.n_statements = 0
+            self.sql_seconds = 0.0
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiler_start_time', []).append(timeit.default_timer())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = timeit.default_timer() - conn.info['profiler_start_time'].pop()
+        key = re.sub(r'\s+', ' ', statement).strip()
+        rows = cursor.rowcount if cursor.rowcount is not None else 0
+        with self._lock:
+            if key not in self.statements:
+                self.statements[key] = _Stats()
+            self.statements[key].add(seconds, rows=rows)
+            self.n_statements += 1
+            self.sql_seconds += seconds
+
+    def _on_error(self, context):
+        # A statement that fails never reaches _after_execute, so its start time is dropped here
+        start_times = context.connection.info.get('profiler_start_time') if context.connection is not None else None
+        if context.execution_context is not None and start_times:
+            start_times.pop()
+
+    def _on_load(self, target, context):
+        name = type(target).__name__
+        with self._lock:
+            self.loaded[name] = self.loaded.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block, and count the SQL statements executed in it.
+        """
+        n_statements = self.n_statements
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            seconds = timeit.default_timer() - start
+            with self._lock:
+                if name not in self.stages:
+                    self.stages[name] = _Stats()
+                self.stages[name].add(seconds, statements=self.n_statements - n_statements)
+
+    def timed(self, name=None):
+        """
+        Decorator that times every call to the decorated function as a stage.
+        :param name: the stage name (defaults to the function name)
+        """
+        def decorator(func):
+            stage_name = func.__name__ if name is None else name
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self):
+        """
+        :return: dictionary with the totals, every stage and every statement (slowest first)
+        """
+        with self._lock:
+            statements = sorted(self.statements.items(), key=lambda kv: kv[1].seconds, reverse=True)
+            return {'n_statements': self.n_statements,
+                    'sql_seconds': self.sql_seconds,
+                    'loaded_instances': dict(self.loaded),
+                    'latency_bins': [float(b) for b in LATENCY_BINS[:-1]] + ['inf'],
+                    'stages': dict((k, v.as_dict()) for k, v in self.stages.items()),
+                    'statements': [dict(statement=k, **v.as_dict()) for k, v in statements]}
+
+    def write(self, filename):
+        """
+        Write the report to a JSON metrics file.
+        """
+        with open(filename, 'w') as outfile:
+            json.dump(self.report(), outfile, indent=2)
+
+    def summary(self, n_statements=10):
+        """
+        :return: a human-readable summary of the stages and the slowest statements
+        """
+        report = self.report()
+        lines = ['{} statements, {:.3f} s in SQL'.format(report['n_statements'], report['sql_seconds']), '',
+                 '{:<40s} {:>8s} {:>10s} {:>10s}'.format('stage', 'calls', 'seconds', 'statements')]
+        for name, stats in sorted(report['stages'].items(), key=lambda kv: kv[1]['seconds'], reverse=True):
+            lines.append('{:<40s} {:>8d} {:>10.3f} {:>10d}'.format(name[:40], stats['count'], stats['seconds'],
+                                                                   stats['statements']))
+        lines += ['', '{:>8s} {:>10s} {:>10s}  statement'.format('calls', 'seconds', 'rows')]
+        for stats in report['statements'][:n_statements]:
+            lines.append('{:>8d} {:>10.3f} {:>10d}  {}'.format(stats['count'], stats['seconds'], stats['rows'],
+                                                              stats['statement'][:100]))
+        return '\n'.join(lines)
+
+
+# Shared profiler for the ingest scripts
+profiler = Profiler()
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+"""
+Database maintenance: planner statistics, vacuuming, consistency checks and a size report.
+
+maintain() runs, in order:
+
+    ANALYZE (the first time, when sqlite_stat1 does not exist yet, or when asked to) or PRAGMA optimize
+    incremental VACUUM. A database that is not in auto_vacuum=INCREMENTAL mode yet is
+        switched to it with one full VACUUM, once more than MAX_FREE_FRACTION of its
+        pages are free. After that, the free pages are returned with PRAGMA incremental_vacuum.
+    PRAGMA integrity_check and PRAGMA foreign_key_check
+    a report of the rows, and the bytes used, by every table and index
+
+On PostgreSQL only ANALYZE, the row counts and the sizes are done (autovacuum takes care of the rest).
+
+track_changes() counts the rows written through an engine by any INSERT,
+UPDATE, DELETE or REPLACE statement (raw SQL included; rows written around
+the engine's cursors, like with COPY, are added with record_changes()), and
+maintain_if_changed() runs maintain() when more than a fraction of the rows
+were changed since, so fill_db can call it at the end of every ingest. It
+always runs a full ANALYZE: PRAGMA optimize on a new connection does not
+refresh existing statistics, however many rows have changed.
+
+Usage:
+    python Maintenance.py Stars.sqlite
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import re
+import sqlite3
+import threading
+
+from sqlalchemy import create_engine, event, inspect as sql_inspect, text
+
+
+# Switch to incremental auto-vacuum once more than this fraction of the pages are free
+MAX_FREE_FRACTION = 0.1
+
+# Rows written per engine since track_changes was called
+_changes = dict()
+_changes_lock = threading.Lock()
+
+# Statements whose rowcount is the number of rows written. This also matches text() statements and
+# INSERT ... SELECT, for which SQLAlchemy does not set the isinsert/isupdate/isdelete flags.
+_WRITE = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+
+def track_changes(engine):
+    """
+    Start counting the rows inserted, updated and deleted through the engine.
+    """
+    with _changes_lock:
+        tracked = engine in _changes
+        _changes[engine] = 0
+    if tracked:
+        return
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _count_changed_rows(conn, cursor, statement, parameters, context, executemany):
+        if cursor.rowcount > 0 and _WRITE.match(statement):
+            record_changes(engine, cursor.rowcount)
+
+
+def record_changes(engine, n_rows):
+    """
+    Count rows written without going through the engine's cursors (e.g. with PostgreSQL COPY).
+    Does nothing if the engine is not tracked.
+    """
+    with _changes_lock:
+        if engine in _changes:
+            _changes[engine] += n_rows
+
+
+def changed_rows(engine):
+    """
+    :return: the number of rows written through the engine since track_changes (None if it is not tracked)
+    """
+    with _changes_lock:
+        return _changes.get(engine)
+
+
+def row_counts(engine):
+    """
+    :return: dictionary of table name --> number of rows
+    """
+    tables = [t for t in sql_inspect(engine).get_table_names() if not t.startswith('sqlite_')]
+    with engine.connect() as connection:
+        return dict((t, connection.execute(text('SELECT COUNT(*) FROM "{}"'.format(t))).scalar()) for t in tables)
+
+
+def _sqlite_sizes(con):
+    """
+    :return: dictionary of table or index name --> (type, bytes), or None if SQLite was built without dbstat
+    """
+    try:
+        sizes = dict(con.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').fetchall())
+    except sqlite3.OperationalError:
+        return None
+    types = dict(con.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'index')").fetchall())
+    return dict((name, (types.get(name, 'table'), size)) for name, size in sizes.items())
+
+
+def _maintain_sqlite(filename, checks=True, analyze=False):
+    """
+    Run the SQLite maintenance steps on a database file.
+    :return: dictionary with the results
+    """
+    report = dict()
+    con = sqlite3.connect(filename, isolation_level=None)
+    try:
+        has_stats = con.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()[0] > 0
+        analyze = analyze or not has_stats
+        con.execute('ANALYZE' if analyze else 'PRAGMA optimize')
+        report['statistics'] = 'analyze' if analyze else 'optimize'
+
+        page_size = con.execute('PRAGMA page_size').fetchone()[0]
+        free_before = con.execute('PRAGMA freelist_count').fetchone()[0]
+        page_count = con.execute('PRAGMA page_count').fetchone()[0]
+        auto_vacuum = con.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if auto_vacuum == 2:
+            con.execute('PRAGMA incremental_vacuum')
+            report['vacuum'] = 'incremental'
+        elif free_before > MAX_FREE_FRACTION * page_count:
+            # auto_vacuum can only be changed by a full VACUUM
+            con.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            con.execute('VACUUM')
+            report['vacuum'] = 'full (switched to incremental auto-vacuum)'
+        else:
+            report['vacuum'] = 'none'
+        free_after = con.execute('PRAGMA freelist_count').fetchone()[0]
+        report['freed_bytes'] = (free_before - free_after) * page_size
+        report['file_bytes'] = con.execute('PRAGMA page_count').fetchone()[0] * page_size
+
+        if checks:
+            report['integrity'] = [row[0] for row in con.execute('PRAGMA integrity_check')]
+            report['foreign_key_errors'] = [tuple(row) for row in con.execute('PRAGMA foreign_key_check')]
+        report['sizes'] = _sqlite_sizes(con)
+    finally:
+        con.close()
+    return report
+
+
+def _maintain_postgresql(engine):
+    report = dict()
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(text('ANALYZE'))
+        report['statistics'] = 'analyze'
+        rows = connection.execute(text("SELECT c.relname, CASE c.relkind WHEN 'i' THEN 'index' ELSE 'table' END, "
+                                       "pg_relation_size(c.oid) FROM pg_class c "
+                                       "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                                       "WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'i')")).fetchall()
+        report['sizes'] = dict((name, (kind, size)) for name, kind, size in rows)
+    return report
+
+
+def maintain(engine, checks=True, verbose=True, analyze=False):
+    """
+    Run the maintenance steps and report the rows and sizes of every table and index.
+    Must not be called inside a transaction.
+    :param engine: a sqlalchemy engine (or the filename of a SQLite database)
+    :param checks: run the integrity and foreign key checks
+    :param analyze: on SQLite, recompute every statistic with ANALYZE instead of PRAGMA optimize
+    :return: dictionary with the results
+    """
+    if not hasattr(engine, 'dialect'):
+        engine = create_engine('sqlite:///{}'.format(engine))
+    if engine.dialect.name == 'sqlite':
+        report = _maintain_sqlite(engine.url.database, checks=checks, analyze=analyze)
+    elif engine.dialect.name == 'postgresql':
+        report = _maintain_postgresql(engine)
+    else:
+        raise ValueError('Maintenance is not implemented for {} databases'.format(engine.dialect.name))
+    report['rows'] = row_counts(engine)
+
+    if checks and report.get('integrity', ['ok']) != ['ok']:
+        logging.warn('Integrity check failed: {}'.format('; '.join(report['integrity'][:10])))
+    if checks and len(report.get('foreign_key_errors', [])) > 0:
+        logging.warn('{} rows have broken foreign keys. First: {}'.format(len(report['foreign_key_errors']),
+                                                                         report['foreign_key_errors'][:5]))
+    if verbose:
+        print(format_report(report))
+    with _changes_lock:
+        if engine in _changes:
+            _changes[engine] = 0
+    return report
+
+
+def format_report(report):
+    """
+    :return: the maintenance report as a printable table
+    """
+    lines = ['statistics: {}    vacuum: {}'.format(report.get('statistics'), report.get('vacuum', 'n/a'))]
+    if 'file_bytes' in report:
+        lines.append('file size: {:.1f} MB ({:.1f} kB freed)'.format(report['file_bytes'] / 1e6,
+                                                                   report['freed_bytes'] / 1e3))
+    if 'integrity' in report:
+        lines.append('integrity: {}    foreign key errors: {}'.format(
+            'ok' if report['integrity'] == ['ok'] else '{} problems'.format(len(report['integrity'])),
+            len(report['foreign_key_errors'])))
+    sizes = report.get('sizes') or dict()
+    names = sorted(set(report['rows']) | set(sizes), key=lambda n: (-sizes.get(n, ('', 0))[1], n))
+    lines.append('{:<40s} {:<6s} {:>10s} {:>12s}'.format('name', 'type', 'rows', 'kB'))
+    for name in names:
+        kind, size = sizes.get(name, ('table', None))
+        lines.append('{:<40s} {:<6s} {:>10s} {:>12s}'.format(
+            name, kind, str(report['rows'].get(name, '')), '' if size is None else '{:.1f}'.format(size / 1e3)))
+    return '\n'.join(lines)
+
+
+def maintain_if_changed(engine, threshold=0.1, min_rows=1000, **kwargs):
+    """
+    Run maintain() if the rows written since track_changes are more than a fraction of the rows in the database.
+    :param threshold: the fraction of the rows that must have changed
+    :param min_rows: ... and the smallest number of changed rows that is worth maintaining for
+    :return: the maintenance report, or None if it was not needed
+    """
+    changed = changed_rows(engine)
+    if changed is None:
+        raise ValueError('Changes are not tracked for this engine. Call track_changes(engine) first.')
+    total = sum(row_counts(engine).values())
+    if changed < min_rows or changed <= threshold * total:
+        return None
+    print('{} of {} rows changed. Running database maintenance.'.format(changed, total))
+    kwargs.setdefault('analyze', True)
+    return maintain(engine, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze, vacuum, check and report on the star database.')
+    parser.add_argument('database', nargs='?', default='Stars.sqlite',
+                        help='SQLite file or SQLAlchemy connection string')
+    parser.add_argument('--no-checks', action='store_true', help='Skip the integrity and foreign key checks')
+    parser.add_argument('--analyze', action='store_true', help='Run a full ANALYZE instead of PRAGMA optimize')
+    args = parser.parse_args()
+
+    target = create_engine(args.database) if '://' in args.database else args.database
+    maintain(target, checks=not args.no_checks, analyze=args.analyze)
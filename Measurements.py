@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+"""
+Optional long-format storage of the measured star quantities.
+
+The star table has a value/error/reference triple for each of the quantities
+in QUANTITIES. The measurement table stores the same information as one row
+per (star, quantity, reference, epoch), so a star can have any number of
+measurements of a quantity, and a new quantity needs no schema change.
+
+The star_view view has exactly the same columns as the star table, with the
+quantities taken from the measurement table (the most recent epoch, then
+the most recently added row), so code that reads the wide columns keeps
+working against it.
+
+Usage:
+    create_measurement_table(engine)
+    migrate_star_columns(session)      # copy the wide star columns into measurement
+    stars_with(session, 'temperature', reference_id=12)
+"""
+
+from __future__ import print_function
+
+from sqlalchemy import text, Table
+
+from ModelClasses import Base, Star, Measurement
+
+
+# Star quantities with a value/error/reference triple. spectral_type has no error, and is stored in text_value.
+QUANTITIES = ['spectral_type', 'temperature', 'logg', 'mass', 'metallicity', 'radius',
+              'vsini', 'vsys', 'parallax', 'Vmag', 'Kmag']
+TEXT_QUANTITIES = ['spectral_type']
+
+
+def star_view_sql():
+    """
+    :return: the CREATE VIEW statement for star_view
+    """
+    expressions = dict()
+    joins = []
+    for q in QUANTITIES:
+        alias = 'm_{}'.format(q)
+        if q in TEXT_QUANTITIES:
+            expressions[q] = '{}.text_value'.format(alias)
+        else:
+            expressions[q] = '{}.value'.format(alias)
+            expressions['{}_error'.format(q)] = '{}.error'.format(alias)
+        expressions['{}_ref_id'.format(q)] = '{}.reference_id'.format(alias)
+        joins.append('LEFT JOIN measurement {a} ON {a}.id = (SELECT m.id FROM measurement m '
+                     'WHERE m.star_id = s.id AND m.quantity = \'{q}\' '
+                     'ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)'.format(a=alias, q=q))
+
+    # Keep the column order of the star table
+    selects = ['{} AS "{}"'.format(expressions[c.name], c.name) if c.name in expressions else 's."{}"'.format(c.name)
+               for c in Star.__table__.columns]
+    return 'CREATE VIEW star_view AS SELECT {} FROM star s\n{}'.format(',\n  '.join(selects), '\n'.join(joins))
+
+
+def create_measurement_table(engine):
+    """
+    Create the measurement table, its indices and star_view, if they do not exist yet.
+    """
+    Measurement.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.execute(text('DROP VIEW IF EXISTS star_view'))
+        connection.execute(text(star_view_sql()))
+
+
+def star_view_table():
+    """
+    :return: a read-only sqlalchemy Table for star_view
+    """
+    if 'star_view' in Base.metadata.tables:
+        return Base.metadata.tables['star_view']
+    return Table('star_view', Base.metadata, autoload=True)
+
+
+def migrate_star_columns(session):
+    """
+    Copy every value in the wide star columns that is not in the measurement table yet,
+    with one INSERT ... SELECT per quantity. A reference with no value (e.g. 'Unknown') is copied too,
+    so that star_view matches the star table exactly.
+    :return: the number of measurements added
+    """
+    n_added = 0
+    for q in QUANTITIES:
+        value, error = ('text_value', 'NULL') if q in TEXT_QUANTITIES else ('value', 's."{}_error"'.format(q))
+        statement = text('INSERT INTO measurement (star_id, quantity, {value}, error, reference_id) '
+                         'SELECT s.id, :quantity, s."{q}", {error}, s."{q}_ref_id" FROM star s '
+                         'WHERE (s."{q}" IS NOT NULL OR s."{q}_ref_id" IS NOT NULL) AND NOT EXISTS ('
+                         'SELECT 1 FROM measurement m WHERE m.star_id = s.id AND m.quantity = :quantity AND '
+                         '(m.reference_id = s."{q}_ref_id" OR (m.reference_id IS NULL AND s."{q}_ref_id" IS NULL)))'
+                         .format(value=value, error=error, q=q))
+        n_added += session.execute(statement, {'quantity': q}).rowcount
+    return n_added
+
+
+def add_measurement(session, star, quantity, value, error=None, reference=None, epoch=None):
+    """
+    Add one measurement of a quantity for a star.
+    :param star: a Star object
+    :param quantity: the quantity name (any name is allowed, not just the ones in QUANTITIES)
+    :param value: the measured value (a string for spectral types)
+    :param reference: a Reference object
+    :param epoch: the epoch of the measurement (e.g. in MJD), used to pick the one shown in star_view
+    :return: the Measurement object
+    """
+    entry = Measurement()
+    entry.star = star
+    entry.quantity = quantity
+    if quantity in TEXT_QUANTITIES:
+        entry.text_value = value
+    else:
+        entry.value = value
+    entry.error = error
+    entry.reference = reference
+    entry.epoch = epoch
+    session.add(entry)
+    return entry
+
+
+def stars_with(session, quantity, reference_id=None):
+    """
+    Find every star with a measurement of the given quantity (optionally from one reference).
+    This is one scan of the (quantity, reference_id, ...) index.
+    :return: list of (star_id, value, error, reference_id) tuples
+    """
+    query = session.query(Measurement.star_id,
+                          Measurement.text_value if quantity in TEXT_QUANTITIES else Measurement.value,
+                          Measurement.error, Measurement.reference_id).filter(Measurement.quantity == quantity)
+    if reference_id is not None:
+        query = query.filter(Measurement.reference_id == reference_id)
+    return query.all()
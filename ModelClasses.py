@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+from sqlalchemy import Column, Integer, Float, Text, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation
 
@@ -72,7 +73,7 @@ class Configuration(Base):
     __table_args__ = {'autoload': True}
 
     def get_primary(self):
-        return self.star_system1.stars
+        return self.primary.stars
 
 
 class Instrument(Base):
@@ -84,17 +85,97 @@ class Spectrum(Base):
     __tablename__ = 'spectrum'
     __table_args__ = {'autoload': True}
 
+    def load(self, store=None):
+        """
+        Load this spectrum from the packed spectrum store
+        :param store: a SpectrumStore instance (defaults to the shared store)
+        :return: (3, n_pixels) memory-mapped array with the wavelength, flux and error
+        """
+        from SpectrumStore import SpectrumStore
+        store = SpectrumStore.default() if store is None else store
+        return store.get(self.id)
+
 
 class CCF(Base):
     __tablename__ = 'ccf'
     __table_args__ = {'autoload': True}
 
+    def load(self, store=None):
+        """
+        Load the full grid of this CCF from the CCF store
+        :param store: a CCFStore instance (defaults to the shared store)
+        :return: array of shape (n_temperature, n_metal, n_vsini, n_rv)
+        """
+        from CCFStore import CCFStore
+        store = CCFStore.default() if store is None else store
+        return store.get(self.id)
+
 
 class Observation(Base):
     __tablename__ = 'observation'
-    __table_args__ = {'autoload': True}  # =========================
+    __table_args__ = {'autoload': True}
+
+
+# The measurement table is optional, so it is not autoloaded. It is created by Measurements.create_measurement_table
+class Measurement(Base):
+    __tablename__ = 'measurement'
+    __table_args__ = (Index('measurement_quantity_reference', 'quantity', 'reference_id', 'star_id', 'value', 'error'),
+                      Index('measurement_star_quantity', 'star_id', 'quantity', 'epoch'))
+
+    id = Column(Integer, primary_key=True)
+    star_id = Column(Integer, ForeignKey('star.id'), nullable=False)
+    quantity = Column(Text, nullable=False)
+    value = Column(Float)
+    text_value = Column(Text)
+    error = Column(Float)
+    reference_id = Column(Integer, ForeignKey('reference.id'))
+    epoch = Column(Float)
+
+
+# The star_alias table is optional too. It is created by StarQueries.create_alias_table
+class Star_Alias(Base):
+    __tablename__ = 'star_alias'
+    __table_args__ = (Index('star_alias_key', 'key', unique=True),
+                      Index('star_alias_star', 'star_id'))
+
+    id = Column(Integer, primary_key=True)
+    star_id = Column(Integer, ForeignKey('star.id'), nullable=False)
+    alias = Column(Text, nullable=False)
+    key = Column(Text, nullable=False)
+    catalog = Column(Text)
 
 
+# The summary tables are derived from the others, and maintained by Summaries.py.
+# Stars without a cluster and observations without an instrument are counted under id 0.
+class Cluster_Summary(Base):
+    __tablename__ = 'cluster_summary'
+
+    cluster_id = Column(Integer, primary_key=True, autoincrement=False)
+    n_stars = Column(Integer, nullable=False)
+    n_systems = Column(Integer, nullable=False)
+    n_multiple = Column(Integer, nullable=False)
+
+
+class Spectral_Class_Summary(Base):
+    __tablename__ = 'spectral_class_summary'
+
+    spectral_class = Column(Text, primary_key=True)
+    vsini_bin = Column(Float, primary_key=True, autoincrement=False)
+    n_stars = Column(Integer, nullable=False)
+    vsini_sum = Column(Float)
+
+
+class Instrument_Summary(Base):
+    __tablename__ = 'instrument_summary'
+
+    instrument_id = Column(Integer, primary_key=True, autoincrement=False)
+    n_observations = Column(Integer, nullable=False)
+    n_stars = Column(Integer, nullable=False)
+    n_spectra = Column(Integer, nullable=False)
+    n_ccfs = Column(Integer, nullable=False)
+
+
+# =========================
 # Define relationships here
 # =========================
 
@@ -135,3 +216,10 @@ Observation.ccf = relation(CCF, backref='observation')
 
 #####     Instrument relationships       #####
 Instrument.reference = relation(Reference)
+
+#####     Measurement relationships       #####
+Measurement.star = relation(Star, backref='measurements')
+Measurement.reference = relation(Reference)
+
+#####     Star alias relationships       #####
+Star_Alias.star = relation(Star, backref='aliases')
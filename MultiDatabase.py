@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+"""
+Work with several SQLite star databases through one connection.
+
+attach_databases() makes every connection of an engine ATTACH the given
+database files, and creates temporary all_<table> views that UNION ALL the
+table from the main database and every attached one (with a source_db
+column telling them apart), so cross-file analyses are single SQL queries.
+A view has the columns of every file, with NULL where a file lacks one:
+
+    SELECT source_db, COUNT(*) FROM all_star WHERE vsini > 100 GROUP BY source_db
+
+merge() copies an attached database into the main one entirely in SQL.
+Stars, references, journals, clusters and instruments that already exist
+(matched by name, or bibcode for references) are not duplicated, nor are
+star systems with the same stars or rows that are otherwise identical;
+every other row gets a new id above the ones in the main database, and all
+the foreign keys are remapped to the new ids. Only the columns that both files
+have are copied, so older schemas can be merged too.
+
+Usage:
+    python MultiDatabase.py merge Stars.sqlite Stars_ffplugin.sqlite
+"""
+
+from __future__ import print_function
+
+import argparse
+from collections import OrderedDict
+
+from sqlalchemy import create_engine, event, MetaData, text
+
+
+# Columns used to recognize the same row in two databases. Rows of the other tables
+# are recognized by the values of all their columns (with the foreign keys remapped),
+# and star systems by the names of their stars.
+NATURAL_KEYS = {'star': 'name',
+                'reference': 'bibcode',
+                'journal': 'name',
+                'cluster': 'name',
+                'instrument': 'name'}
+SYSTEM_KEY = ("(SELECT group_concat(name, '|') FROM (SELECT st.name FROM {schema}.star_to_star_system x "
+              "JOIN {schema}.star st ON st.id = x.star_id WHERE x.star_system_id = {row}.id ORDER BY st.name))")
+
+
+def _quote(name):
+    return '"{}"'.format(name)
+
+
+def _tables(dbapi_con, schema):
+    """
+    :return: dictionary of lower-case table name --> table name as stored in the given (attached) database
+    """
+    rows = dbapi_con.execute("SELECT name FROM {}.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+                             .format(_quote(schema))).fetchall()
+    return dict((r[0].lower(), r[0]) for r in rows)
+
+
+def _columns(dbapi_con, schema, table):
+    return [r[1] for r in dbapi_con.execute('PRAGMA {}.table_info({})'.format(_quote(schema), _quote(table)))]
+
+
+def create_unified_views(dbapi_con, aliases):
+    """
+    Create a TEMP all_<table> view for every table in the main and attached databases, over all of them.
+    Table and column names are matched without regard to case. A view has every column that any of
+    the databases has, and the rows from a database without that column have NULL in it.
+    """
+    schemas = ['main'] + list(aliases)
+    tables = dict((schema, _tables(dbapi_con, schema)) for schema in schemas)
+    keys = sorted(set(key for schema in schemas for key in tables[schema]))
+    for key in keys:
+        sources = [(schema, tables[schema][key]) for schema in schemas if key in tables[schema]]
+        # lower-case name --> column name, in each database and in the view (spelled as in the first database)
+        source_columns = []
+        union = OrderedDict()
+        for schema, name in sources:
+            columns = _columns(dbapi_con, schema, name)
+            source_columns.append(dict((c.lower(), c) for c in columns))
+            for c in columns:
+                union.setdefault(c.lower(), c)
+        selects = []
+        for (schema, name), columns in zip(sources, source_columns):
+            values = ['{} AS {}'.format(_quote(columns[lower]) if lower in columns else 'NULL', _quote(column))
+                      for lower, column in union.items()]
+            selects.append("SELECT '{}' AS source_db, {} FROM {}.{}".format(schema, ', '.join(values),
+                                                                           _quote(schema), _quote(name)))
+        dbapi_con.execute('DROP VIEW IF EXISTS temp.{}'.format(_quote('all_{}'.format(key))))
+        dbapi_con.execute('CREATE TEMP VIEW {} AS {}'.format(_quote('all_{}'.format(key)), ' UNION ALL '.join(selects)))
+
+
+def attach_databases(engine, databases):
+    """
+    ATTACH the given SQLite files to every connection of the engine and create the unified views.
+    :param engine: a sqlalchemy engine on the main SQLite database
+    :param databases: dictionary of schema alias --> filename (e.g. {'ff': 'Stars_ffplugin.sqlite'})
+    """
+    @event.listens_for(engine, 'connect')
+    def _attach_on_connect(dbapi_con, connection_record):
+        for alias, filename in sorted(databases.items()):
+            dbapi_con.execute('ATTACH DATABASE ? AS {}'.format(_quote(alias)), (filename,))
+        create_unified_views(dbapi_con, sorted(databases))
+
+    # Connections that are already open do not have the databases attached
+    engine.dispose()
+
+
+def merge(connection, alias):
+    """
+    Merge an attached database into the main database, in one transaction.
+    :param connection: a sqlalchemy connection with the database attached as alias
+    :param alias: the schema alias of the attached database
+    :return: dictionary of table name --> number of rows added
+    """
+    dbapi_con = connection.connection
+    metadata = MetaData()
+    metadata.reflect(bind=connection, only=lambda name, _: not name.startswith('sqlite_'))
+    source_tables = _tables(dbapi_con, alias)
+
+    added = dict()
+    mapped = set()
+    with connection.begin():
+        for table in metadata.sorted_tables:
+            source = source_tables.get(table.name.lower())
+            if source is None:
+                continue
+            source_columns = set(c.lower() for c in _columns(dbapi_con, alias, source))
+            columns = [c.name for c in table.columns if c.name.lower() in source_columns]
+            pk = [c.name for c in table.primary_key.columns]
+
+            # Foreign keys are remapped through the id maps of the tables they point to
+            fk_map = dict((fk.parent.name, fk.column.table.name) for fk in table.foreign_keys
+                          if fk.column.table.name in mapped)
+
+            def value(column):
+                if column in fk_map:
+                    return '(SELECT new_id FROM temp.{} WHERE old_id = s.{})'.format(
+                        _quote('map_{}'.format(fk_map[column])), _quote(column))
+                return 's.{}'.format(_quote(column))
+
+            before = connection.execute(text('SELECT COUNT(*) FROM main.{}'.format(_quote(table.name)))).scalar()
+            if pk == ['id']:
+                others = [c for c in columns if c != 'id']
+                offset = connection.execute(text('SELECT COALESCE(MAX(id), 0) FROM main.{}'
+                                                 .format(_quote(table.name)))).scalar()
+                if NATURAL_KEYS.get(table.name) in others:
+                    main_key = 'm.{}'.format(_quote(NATURAL_KEYS[table.name]))
+                    source_key = 's.{}'.format(_quote(NATURAL_KEYS[table.name]))
+                elif table.name == 'star_system' and 'star_to_star_system' in source_tables and \
+                        'name' in [c.lower() for c in _columns(dbapi_con, alias, source_tables.get('star', 'star'))]:
+                    main_key = SYSTEM_KEY.format(schema='main', row='m')
+                    source_key = SYSTEM_KEY.format(schema=_quote(alias), row='s')
+                elif len(others) > 0:
+                    main_key = " || '|' || ".join('quote(m.{})'.format(_quote(c)) for c in others)
+                    source_key = " || '|' || ".join('quote({})'.format(value(c)) for c in others)
+                else:
+                    main_key = source_key = 'NULL'
+
+                # Build the old id --> new id map for this table: the id of the same row in the main database,
+                # or a new id above the main ones (shared by the rows that are the same in the other database)
+                map_table = _quote('map_{}'.format(table.name))
+                for statement in ['DROP TABLE IF EXISTS temp.key_main', 'DROP TABLE IF EXISTS temp.key_source',
+                                  'CREATE TEMP TABLE key_main AS SELECT m.id AS id, {} AS key FROM main.{} m'
+                                  .format(main_key, _quote(table.name)),
+                                  'CREATE TEMP TABLE key_source AS SELECT s.id AS id, {} AS key FROM {}.{} s'
+                                  .format(source_key, _quote(alias), _quote(source)),
+                                  'CREATE INDEX temp.key_main_key ON key_main (key)',
+                                  'CREATE INDEX temp.key_source_key ON key_source (key)',
+                                  'DROP TABLE IF EXISTS temp.{}'.format(map_table),
+                                  'CREATE TEMP TABLE {} (old_id INTEGER PRIMARY KEY, new_id INTEGER)'.format(map_table),
+                                  'INSERT INTO temp.{map} SELECT k.id, COALESCE('
+                                  '(SELECT MIN(km.id) FROM temp.key_main km WHERE km.key = k.key), '
+                                  '(SELECT MIN(k2.id) FROM temp.key_source k2 WHERE k2.key = k.key) + {offset}, '
+                                  'k.id + {offset}) FROM temp.key_source k'.format(map=map_table, offset=offset),
+                                  'CREATE INDEX temp.{} ON {} (new_id)'.format(
+                                      _quote('map_{}_new'.format(table.name)), map_table),
+                                  'DROP TABLE temp.key_main', 'DROP TABLE temp.key_source']:
+                    connection.execute(text(statement))
+                mapped.add(table.name)
+
+                # Insert one row per new id
+                connection.execute(text(
+                    'INSERT INTO main.{t} (id{cols}) SELECT m.new_id{vals} FROM {alias}.{src} s '
+                    'JOIN temp.{map} m ON m.old_id = s.id '
+                    'WHERE m.new_id > {offset} AND s.id = (SELECT MIN(m2.old_id) FROM temp.{map} m2 '
+                    'WHERE m2.new_id = m.new_id)'.format(
+                        t=_quote(table.name), cols=''.join(', ' + _quote(c) for c in others),
+                        vals=''.join(', ' + value(c) for c in others), alias=_quote(alias), src=_quote(source),
+                        map=map_table, offset=offset)))
+            else:
+                # Association tables: copy the (remapped) rows that are not there yet
+                connection.execute(text('INSERT INTO main.{t} ({cols}) SELECT {vals} FROM {alias}.{src} s '
+                                        'EXCEPT SELECT {cols} FROM main.{t}'.format(
+                                            t=_quote(table.name), cols=', '.join(_quote(c) for c in columns),
+                                            vals=', '.join(value(c) for c in columns), alias=_quote(alias),
+                                            src=_quote(source))))
+            after = connection.execute(text('SELECT COUNT(*) FROM main.{}'.format(_quote(table.name)))).scalar()
+            added[table.name] = after - before
+            print('{:<24s} {:>8d} rows added'.format(table.name, added[table.name]))
+
+        for name in mapped:
+            connection.execute(text('DROP TABLE temp.{}'.format(_quote('map_{}'.format(name)))))
+    return added
+
+
+def merge_files(main_filename, other_filename, alias='other'):
+    """
+    Merge the SQLite file other_filename into main_filename.
+    """
+    engine = create_engine('sqlite:///{}'.format(main_filename))
+    connection = engine.connect()
+    try:
+        connection.execute(text('ATTACH DATABASE :filename AS {}'.format(_quote(alias))), filename=other_filename)
+        return merge(connection, alias)
+    finally:
+        connection.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge several SQLite star databases.')
+    subparsers = parser.add_subparsers(dest='command')
+    merge_parser = subparsers.add_parser('merge', help='Merge one or more databases into the main one')
+    merge_parser.add_argument('main', help='The SQLite file to merge into')
+    merge_parser.add_argument('others', nargs='+', help='The SQLite files to merge')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        for filename in args.others:
+            print('Merging {} into {}'.format(filename, args.main))
+            merge_files(args.main, filename)
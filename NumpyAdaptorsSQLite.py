@@ -37,7 +37,6 @@ if using_sqlite and numpy_available:
     def adapt_np_uint32(np_uint32): return int(np_uint32)
     def adapt_np_uint64(np_uint64): return int(np_uint64)
 
-    def adapt_np_float(np_float): return float(np.float)
     def adapt_np_float16(np_float16): return float(np_float16)
     def adapt_np_float32(np_float32): return float(np_float32)
     def adapt_np_float64(np_float64): return float(np_float64)
@@ -57,8 +56,7 @@ if using_sqlite and numpy_available:
     sqlite3.register_adapter(np.uint16, adapt_np_uint16)
     sqlite3.register_adapter(np.uint32, adapt_np_uint32)
     sqlite3.register_adapter(np.uint64, adapt_np_uint64)
-    sqlite3.register_adapter(np.float, adapt_np_float)
     sqlite3.register_adapter(np.float16, adapt_np_float16)
     sqlite3.register_adapter(np.float32, adapt_np_float32)
     sqlite3.register_adapter(np.float64, adapt_np_float64)
-    sqlite3.register_adapter(np.bool, adapt_np_bool)
+    sqlite3.register_adapter(np.bool_, adapt_np_bool)
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+"""
+Opt-in cache for the results of read queries.
+
+Results are keyed on the compiled SQL of the query and its bound parameters,
+and each entry remembers the write counter of every table the query reads
+from. The counters are bumped whenever a session flushes changes to a table
+(and whenever a Core INSERT/UPDATE/DELETE is executed), so a cached result is
+only served while none of its tables have been written to since it was stored.
+
+Usage:
+    from SQLiteConnection import Session
+    from QueryCache import QueryCache
+
+    cache = QueryCache(maxsize=1000)
+    session = Session()
+    stars = cache.all(session.query(Star).filter(Star.cluster_id == 3))
+    star = cache.one(session.query(Star).filter(Star.name == 'HIP 12345'))
+
+Writes made with raw SQL strings are not seen by the counters; call
+invalidate() with the names of the tables they touch.
+"""
+
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, object_mapper, make_transient_to_detached
+from sqlalchemy.orm.attributes import instance_state, instance_dict, NO_VALUE
+from sqlalchemy.schema import Table
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.util import find_tables
+
+
+# table name --> number of writes seen so far
+_write_counters = dict()
+_counter_lock = threading.Lock()
+
+
+def invalidate(*tables):
+    """
+    Mark the given tables (names or Table objects) as changed, so that no cached result using them is served again.
+    """
+    with _counter_lock:
+        for table in tables:
+            name = table.name if isinstance(table, Table) else table
+            _write_counters[name] = _write_counters.get(name, 0) + 1
+
+
+def table_versions(tables):
+    """
+    :return: tuple of (table name, write counter) pairs for the given table names
+    """
+    with _counter_lock:
+        return tuple((name, _write_counters.get(name, 0)) for name in sorted(tables))
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_flushed_tables(session, flush_context):
+    tables = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        mapper = object_mapper(obj)
+        tables.update(t.name for t in mapper.tables)
+        # Collection changes are written to the association tables, which are not part of the mapper
+        tables.update(r.secondary.name for r in mapper.relationships if r.secondary is not None)
+    if len(tables) > 0:
+        invalidate(*tables)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+def _count_bulk_update(update_context):
+    invalidate(update_context.primary_table)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def _count_bulk_delete(delete_context):
+    invalidate(delete_context.primary_table)
+
+
+@event.listens_for(Engine, 'after_execute')
+def _count_core_writes(conn, clauseelement, multiparams, params, result):
+    if isinstance(clauseelement, UpdateBase):
+        invalidate(clauseelement.table)
+
+
+class _Snapshot():
+    """
+    The column values of an ORM instance as it was loaded, independent of the session it came from.
+    """
+    __slots__ = ('manager', 'key', 'values')
+
+    def __init__(self, obj):
+        state = instance_state(obj)
+        self.manager = state.manager
+        self.key = state.key
+        self.values = dict()
+        for prop in state.mapper.column_attrs:
+            if prop.key in state.dict:
+                # The loaded value, not one changed in the session and not flushed yet
+                value = state.committed_state.get(prop.key, state.dict[prop.key])
+                if value is not NO_VALUE:
+                    self.values[prop.key] = value
+
+    def instance(self, session):
+        """
+        :return: the instance with this identity in the session, or a new one built from the values
+        """
+        obj = session.identity_map.get(self.key)
+        if obj is None:
+            obj = self.manager.new_instance()
+            instance_dict(obj).update(self.values)
+            make_transient_to_detached(obj)
+            session.add(obj)
+        return obj
+
+
+def _snapshot(row):
+    if isinstance(row, tuple):
+        return tuple(_snapshot(value) for value in row), getattr(row, '_fields', None)
+    if hasattr(row, '_sa_instance_state'):
+        return _Snapshot(row)
+    return row
+
+
+def _rebuild(row, session):
+    if isinstance(row, _Snapshot):
+        return row.instance(session)
+    if isinstance(row, tuple):
+        values, fields = row
+        values = [_rebuild(value, session) for value in values]
+        return tuple(values) if fields is None else sqlalchemy.util.KeyedTuple(values, fields)
+    return row
+
+
+class QueryCache():
+    def __init__(self, maxsize=1024, max_rows=None):
+        """
+        :param maxsize: the maximum number of distinct queries to keep
+        :param max_rows: the maximum total number of result rows to keep (None for no limit)
+        """
+        self.maxsize = maxsize
+        self.max_rows = max_rows
+        self.n_rows = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query):
+        """
+        :return: (cache key, names of the tables the query reads from)
+        """
+        statement = query.with_labels().statement
+        compiled = statement.compile(dialect=query.session.get_bind().dialect)
+        params = tuple(sorted((k, repr(v)) for k, v in compiled.params.items()))
+        tables = set(t.name for t in find_tables(statement, include_aliases=True) if isinstance(t, Table))
+        return (str(compiled), params), tables
+
+    def _store(self, key, versions, rows):
+        with self._lock:
+            if key in self._entries:
+                self.n_rows -= len(self._entries.pop(key)[1])
+            self._entries[key] = (versions, rows)
+            self.n_rows += len(rows)
+            while len(self._entries) > self.maxsize or (self.max_rows is not None and
+                                                        self.n_rows > self.max_rows and len(self._entries) > 1):
+                _, (_, old_rows) = self._entries.popitem(last=False)
+                self.n_rows -= len(old_rows)
+
+    def _lookup(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != versions:
+                # One of the tables has been written to since this was cached
+                del self._entries[key]
+                self.n_rows -= len(entry[1])
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def all(self, query):
+        """
+        Cached equivalent of query.all().
+        The cache keeps copies of the column values, not the instances of the session that ran the query.
+        On a hit, instances that are already in the query's session are returned as they are, and the
+        others are rebuilt from the copies and added to the session without going to the database.
+        """
+        key, tables = self._key(query)
+        versions = table_versions(tables)
+        rows = self._lookup(key, versions)
+        if rows is None:
+            self.misses += 1
+            rows = query.all()
+            self._store(key, versions, [_snapshot(row) for row in rows])
+            return rows
+        self.hits += 1
+        session = query.session
+        with session.no_autoflush:
+            return [_rebuild(row, session) for row in rows]
+
+    def one(self, query):
+        """
+        Cached equivalent of query.one().
+        Raises the same NoResultFound/MultipleResultsFound exceptions as query.one()
+        """
+        rows = self.all(query)
+        if len(rows) == 0:
+            raise sqlalchemy.orm.exc.NoResultFound('No row was found for one()')
+        if len(rows) > 1:
+            raise sqlalchemy.orm.exc.MultipleResultsFound('Multiple rows were found for one()')
+        return rows[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_rows = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,484 @@
+#!/usr/bin/python
+
+"""
+Long-running HTTP query service for the star database.
+
+The service holds one DatabaseConnection with a pool of connections shared by
+a pool of worker threads, so the schema is reflected once and clients need
+neither the ORM nor a database driver. Every endpoint takes its parameters
+from the query string:
+
+    /cone?ra=83.82&dec=-5.39&radius=0.5   stars within radius degrees of ra, dec (in degrees), nearest first
+    /star?name=HD 37742                   one star, by name or any alias (or id=)
+    /system?name=HD 37742                 the star systems above and below the star's systems
+    /export?columns=id,name,vsini         whole columns of the star table, with optional
+                                          <column>=, min_<column>= and max_<column>= filters
+
+Results are columns of values (converted as for a StarTable, so NULL ids are
+-1 and other NULL numbers NaN), as JSON by default. With format=npy (or
+Accept: application/x-npy) they are a NumPy structured array in .npy format,
+and with format=arrow (or Accept: application/vnd.apache.arrow.stream) an
+Arrow IPC stream (needs pyarrow). Encoded results are cached, and a cached
+result is only served while none of the tables it reads have been written to
+by this process (see QueryCache.py). Run it on a snapshot (see Snapshot.py),
+or with --cache-size 0 if other processes write to the database.
+
+Usage:
+    python QueryService.py --snapshot Stars_snapshot.sqlite --port 8765
+
+    from QueryService import fetch
+    stars = fetch('cone', ra=83.82, dec=-5.39, radius=0.5)         # numpy structured array
+"""
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from urllib.request import urlopen, Request
+
+import numpy as np
+from sqlalchemy import select, or_
+from sqlalchemy.pool import QueuePool
+
+from DatabaseConnection import DatabaseConnection
+from Snapshot import snapshot_connection_string, use_mmap
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+DEFAULT_PORT = 8765
+CONTENT_TYPES = {'json': 'application/json',
+                 'npy': 'application/x-npy',
+                 'arrow': 'application/vnd.apache.arrow.stream'}
+DEFAULT_CONE_COLUMNS = ['id', 'name', 'RA', 'DEC']
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          406: 'Not Acceptable', 500: 'Internal Server Error'}
+
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def connect(connection_string='sqlite:///Stars.sqlite', pool_size=8, snapshot=None):
+    """
+    Create the shared DatabaseConnection, with a pool of pool_size connections.
+    This must be called before ModelClasses is imported.
+    :param snapshot: the filename of a read-only snapshot (see Snapshot.py) to open instead of connection_string
+    :return: the engine
+    """
+    if snapshot is not None:
+        connection_string = snapshot_connection_string(snapshot)
+    options = dict(poolclass=QueuePool, pool_size=pool_size, max_overflow=0)
+    if connection_string.startswith('sqlite'):
+        # The pool hands every connection to one worker thread at a time
+        options['connect_args'] = {'check_same_thread': False}
+    db = DatabaseConnection(connection_string, **options)
+    if snapshot is not None:
+        use_mmap(db.engine)
+    return db.engine
+
+
+def encode(columns, fmt, single=False):
+    """
+    Encode a result.
+    :param columns: OrderedDict of column name --> numpy array
+    :param fmt: 'json', 'npy' or 'arrow'
+    :param single: for JSON, return the first row as an object instead of the columns
+    :return: the response body (bytes)
+    """
+    if fmt == 'npy':
+        n_rows = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+        table = np.empty(n_rows, dtype=[(name, values.dtype) for name, values in columns.items()])
+        for name, values in columns.items():
+            table[name] = values
+        buf = io.BytesIO()
+        np.save(buf, table, allow_pickle=False)
+        return buf.getvalue()
+    if fmt == 'arrow':
+        table = pyarrow.Table.from_arrays([pyarrow.array(values, from_pandas=True) for values in columns.values()],
+                                          names=list(columns))
+        sink = pyarrow.BufferOutputStream()
+        writer = pyarrow.ipc.new_stream(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+        return sink.getvalue().to_pybytes()
+    lists = OrderedDict((name, [None if isinstance(v, float) and v != v else v for v in values.tolist()])
+                        for name, values in columns.items())
+    if single:
+        lists = OrderedDict((name, values[0]) for name, values in lists.items())
+    return json.dumps(lists).encode('utf-8')
+
+
+class QueryService():
+    def __init__(self, pool_size=8, cache_size=1024):
+        """
+        :param pool_size: the number of worker threads (use the pool_size given to connect)
+        :param cache_size: the number of encoded results to keep (0 to disable the cache)
+        """
+        # ModelClasses reflects the schema with the engine made by connect(), so it is only imported now
+        import QueryCache
+        import StarQueries
+        import SystemHierarchy
+        import StarTable
+        from ModelClasses import Star
+        self._table_versions = QueryCache.table_versions
+        self._normalize_name = StarQueries.normalize_name
+        self._system_graph = SystemHierarchy.SystemGraph
+        self._column_array = StarTable.column_array
+
+        db = DatabaseConnection()
+        self.engine = db.engine
+        self.Session = db.Session
+        self.star_table = Star.__table__
+        with self.engine.connect() as connection:
+            self.has_aliases = self.engine.dialect.has_table(connection, 'star_alias')
+
+        self.executor = ThreadPoolExecutor(pool_size)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._names = (None, None)
+        self._graph = (None, None)
+
+        self.endpoints = {'cone': (self.cone, ('star',)),
+                          'star': (self.star, ('star', 'star_alias')),
+                          'system': (self.system, ('star', 'star_to_star_system', 'configuration')),
+                          'export': (self.export, ('star',))}
+
+    # ----------------------------------------------------------------
+    # Shared in-memory indices, rebuilt when their tables change
+    # ----------------------------------------------------------------
+    def _name_index(self, session):
+        """
+        :return: dictionary of normalized name or alias --> star id
+        """
+        versions = self._table_versions(['star', 'star_alias'])
+        with self._lock:
+            if self._names[0] != versions:
+                names = dict((self._normalize_name(name), star_id) for star_id, name in
+                             session.execute(select([self.star_table.c.id, self.star_table.c.name]))
+                             if name is not None)
+                if self.has_aliases:
+                    names.update(session.execute('SELECT key, star_id FROM star_alias').fetchall())
+                self._names = (versions, names)
+            return self._names[1]
+
+    def _graph_of(self, session):
+        versions = self._table_versions(['star_to_star_system', 'configuration'])
+        with self._lock:
+            if self._graph[0] != versions:
+                self._graph = (versions, self._system_graph(session))
+            return self._graph[1]
+
+    def _star_id(self, session, params):
+        if 'id' in params:
+            try:
+                return int(params['id'])
+            except ValueError:
+                raise QueryError(400, 'The star id must be an integer, not "{}"'.format(params['id']))
+        if 'name' not in params:
+            raise QueryError(400, 'Give the name or id of the star')
+        star_id = self._name_index(session).get(self._normalize_name(params['name']))
+        if star_id is None:
+            raise QueryError(404, 'Unknown star "{}"'.format(params['name']))
+        return star_id
+
+    def _columns(self, names):
+        """
+        :return: the star table columns with the given names (all of them if names is None)
+        """
+        if names is None:
+            return list(self.star_table.columns)
+        unknown = [name for name in names if name not in self.star_table.c]
+        if len(unknown) > 0:
+            raise QueryError(400, 'Unknown star column(s): {}'.format(', '.join(unknown)))
+        return [self.star_table.c[name] for name in names]
+
+    def _fetch(self, session, columns, statement):
+        """
+        :return: OrderedDict of column name --> numpy array with the result of the statement
+        """
+        rows = session.execute(statement).fetchall()
+        return OrderedDict((c.name, self._column_array(c, [row[i] for row in rows])) for i, c in enumerate(columns))
+
+    # ----------------------------------------------------------------
+    # Endpoints. Each returns (OrderedDict of columns, whether the result is a single row)
+    # ----------------------------------------------------------------
+    def cone(self, session, params):
+        """
+        Stars within radius degrees of (ra, dec), nearest first, with a separation column in degrees.
+        ra is in degrees (the RA column of the star table is in hours).
+        """
+        try:
+            ra, dec, radius = float(params['ra']), float(params['dec']), float(params['radius'])
+        except (KeyError, ValueError):
+            raise QueryError(400, 'Give ra, dec and radius in degrees')
+        if not (0 < radius <= 180 and -90 <= dec <= 90):
+            raise QueryError(400, 'radius must be in (0, 180] and dec in [-90, 90]')
+        names = params['columns'].split(',') if 'columns' in params else DEFAULT_CONE_COLUMNS
+        columns = self._columns(names)
+        star = self.star_table
+
+        # Bounding box on RA/DEC in SQL, then the exact separation in numpy
+        ra_degrees = star.c.RA * 15
+        condition = star.c.DEC.between(dec - radius, dec + radius)
+        if abs(dec) + radius < 90:
+            half_width = math.degrees(math.asin(math.sin(math.radians(radius)) / math.cos(math.radians(dec))))
+            low, high = (ra - half_width) % 360, (ra + half_width) % 360
+            condition = condition & (ra_degrees.between(low, high) if low <= high else
+                                     or_(ra_degrees >= low, ra_degrees <= high))
+        coordinates = [star.c.RA.label('_ra'), star.c.DEC.label('_dec')]
+        result = self._fetch(session, columns + coordinates, select(columns + coordinates).where(condition))
+        star_ra, star_dec = result.pop('_ra') * 15, result.pop('_dec')
+
+        d_ra, d_dec = np.radians(star_ra - ra), np.radians(star_dec - dec)
+        hav = np.sin(d_dec / 2) ** 2 + np.cos(np.radians(dec)) * np.cos(np.radians(star_dec)) * np.sin(d_ra / 2) ** 2
+        separation = np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1))))
+        keep = np.flatnonzero(separation <= radius)
+        keep = keep[np.argsort(separation[keep], kind='mergesort')]
+        output = OrderedDict((name, values[keep]) for name, values in result.items())
+        output['separation'] = separation[keep]
+        return output, False
+
+    def star(self, session, params):
+        """
+        Every column of one star.
+        """
+        star_id = self._star_id(session, params)
+        columns = self._columns(None)
+        result = self._fetch(session, columns, select(columns).where(self.star_table.c.id == star_id))
+        if len(result['id']) == 0:
+            raise QueryError(404, 'There is no star with id {}'.format(star_id))
+        return result, True
+
+    def system(self, session, params):
+        """
+        The hierarchy of every top-level system that the star is part of, as one row per (system, star):
+        system_id, parent_id (-1 for the top-level systems), depth, star_id and name.
+        """
+        star_id = self._star_id(session, params)
+        graph = self._graph_of(session)
+        systems = graph.systems_of_star(star_id)
+        if len(systems) == 0:
+            raise QueryError(404, 'Star {} is not in any star system'.format(star_id))
+
+        roots = set()
+        for system_id in systems:
+            above = graph.ancestors(system_id)
+            top = [s for s in above if len(graph.parents(s)) == 0]
+            roots.update(top if len(top) > 0 else [system_id])
+
+        rows = []
+        for root in sorted(roots):
+            frontier = [(int(root), -1)]
+            depth = 0
+            while len(frontier) > 0:
+                nxt = []
+                for system_id, parent_id in frontier:
+                    rows.extend((system_id, parent_id, depth, int(s)) for s in graph.stars(system_id))
+                    nxt.extend((int(child), system_id) for child in graph.children(system_id))
+                frontier = nxt
+                depth += 1
+
+        star = self.star_table
+        star_ids = sorted(set(row[3] for row in rows))
+        names = dict()
+        for i in range(0, len(star_ids), 500):
+            names.update(session.execute(select([star.c.id, star.c.name])
+                                         .where(star.c.id.in_(star_ids[i:i + 500]))).fetchall())
+        output = OrderedDict()
+        for k, name in enumerate(['system_id', 'parent_id', 'depth', 'star_id']):
+            output[name] = np.array([row[k] for row in rows], dtype=np.int64)
+        output['name'] = np.array([names.get(row[3]) or '' for row in rows], dtype=np.str_)
+        return output, False
+
+    def export(self, session, params):
+        """
+        Whole columns of the star table, in id order.
+        Other parameters are filters: <column>=value, min_<column>=value and max_<column>=value.
+        """
+        columns = self._columns(params['columns'].split(',') if 'columns' in params else None)
+        statement = select(columns).order_by(self.star_table.c.id)
+        for key, value in params.items():
+            if key in ('columns', 'format'):
+                continue
+            if key.startswith('min_'):
+                statement = statement.where(self._columns([key[4:]])[0] >= value)
+            elif key.startswith('max_'):
+                statement = statement.where(self._columns([key[4:]])[0] <= value)
+            else:
+                statement = statement.where(self._columns([key])[0] == value)
+        return self._fetch(session, columns, statement), False
+
+    # ----------------------------------------------------------------
+    # Request handling
+    # ----------------------------------------------------------------
+    def _format(self, params, accept):
+        fmt = params.get('format')
+        if fmt is None:
+            fmt = 'json'
+            for name, content_type in CONTENT_TYPES.items():
+                if content_type in accept:
+                    fmt = name
+        if fmt not in CONTENT_TYPES:
+            raise QueryError(400, 'Unknown format "{}". Use json, npy or arrow'.format(fmt))
+        if fmt == 'arrow' and pyarrow is None:
+            raise QueryError(406, 'Arrow responses need pyarrow, which is not installed')
+        return fmt
+
+    def _cached(self, key, tables):
+        if self.cache_size == 0:
+            return None
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or entry[0] != self._table_versions(tables):
+                return None
+            self._cache.move_to_end(key)
+            return entry[1]
+
+    def handle(self, endpoint, params, accept=''):
+        """
+        Answer one request (in a worker thread).
+        :return: (HTTP status, content type, body)
+        """
+        try:
+            fmt = self._format(params, accept)
+            if endpoint not in self.endpoints:
+                raise QueryError(404, 'Unknown endpoint "{}". Use one of {}'.format(endpoint, sorted(self.endpoints)))
+            function, tables = self.endpoints[endpoint]
+            key = (endpoint, fmt, tuple(sorted(params.items())))
+            body = self._cached(key, tables)
+            if body is None:
+                versions = self._table_versions(tables)
+                session = self.Session()
+                try:
+                    columns, single = function(session, params)
+                finally:
+                    self.Session.remove()
+                body = encode(columns, fmt, single=single)
+                if self.cache_size > 0:
+                    with self._lock:
+                        self._cache[key] = (versions, body)
+                        while len(self._cache) > self.cache_size:
+                            self._cache.popitem(last=False)
+            return 200, CONTENT_TYPES[fmt], body
+        except QueryError as e:
+            return e.status, 'application/json', json.dumps({'error': str(e)}).encode('utf-8')
+        except Exception as e:
+            logging.exception('Error answering /{} {}'.format(endpoint, params))
+            return 500, 'application/json', json.dumps({'error': repr(e)}).encode('utf-8')
+
+    async def _respond(self, request_line, headers):
+        parts = request_line.split()
+        if len(parts) != 3:
+            return 'GET', 400, 'application/json', b'{"error": "Malformed request"}'
+        method, target, _ = parts
+        if method not in ('GET', 'HEAD'):
+            return method, 405, 'application/json', b'{"error": "Only GET is supported"}'
+        url = urlsplit(target)
+        endpoint, params = url.path.strip('/'), dict(parse_qsl(url.query))
+        if endpoint == 'health':
+            return method, 200, 'application/json', b'{"status": "ok"}'
+        loop = asyncio.get_event_loop()
+        status, content_type, body = await loop.run_in_executor(self.executor, self.handle, endpoint, params,
+                                                                headers.get('accept', ''))
+        return method, status, content_type, body
+
+    async def _serve_client(self, reader, writer):
+        """
+        Answer the requests on one (keep-alive) connection.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if len(request_line) == 0:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # Without a valid length the rest of the stream cannot be read, so the connection is closed
+                    method, status, content_type, body = 'GET', 400, 'application/json', \
+                        b'{"error": "Invalid Content-Length"}'
+                    keep_alive = False
+                else:
+                    if length > 0:
+                        await reader.readexactly(length)
+                    request_line = request_line.decode('latin-1')
+                    method, status, content_type, body = await self._respond(request_line, headers)
+                    keep_alive = request_line.rstrip().endswith('HTTP/1.1') and \
+                        headers.get('connection', '').lower() != 'close'
+                head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, STATUS[status], content_type, len(body), 'keep-alive' if keep_alive else 'close')
+                writer.write(head.encode('latin-1') + (body if method != 'HEAD' else b''))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT):
+        server = await asyncio.start_server(self._serve_client, host, port)
+        print('Serving the star database on http://{}:{}/'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host='127.0.0.1', port=DEFAULT_PORT):
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            self.executor.shutdown()
+
+
+def fetch(endpoint, host='127.0.0.1', port=DEFAULT_PORT, format='npy', **params):
+    """
+    Query a running service.
+    :param endpoint: 'cone', 'star', 'system' or 'export'
+    :param format: 'npy' (returns a numpy structured array), 'arrow' (a pyarrow Table) or 'json' (a dictionary)
+    :param params: the endpoint parameters (e.g. ra=83.82, dec=-5.39, radius=0.5)
+    """
+    params['format'] = format
+    url = 'http://{}:{}/{}?{}'.format(host, port, endpoint, urlencode(params))
+    body = urlopen(Request(url)).read()
+    if format == 'npy':
+        return np.load(io.BytesIO(body), allow_pickle=False)
+    if format == 'arrow':
+        return pyarrow.ipc.open_stream(body).read_all()
+    return json.loads(body.decode('utf-8'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the star database over HTTP.')
+    parser.add_argument('--db', default='sqlite:///Stars.sqlite', help='SQLAlchemy connection string of the database')
+    parser.add_argument('--snapshot', help='Serve this read-only snapshot (see Snapshot.py) instead of --db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--pool-size', type=int, default=8, help='Database connections and worker threads')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Number of results to cache (0 to disable)')
+    args = parser.parse_args()
+
+    connect(args.db, pool_size=args.pool_size, snapshot=args.snapshot)
+    QueryService(pool_size=args.pool_size, cache_size=args.cache_size).run(args.host, args.port)
@@ -7,6 +7,8 @@ from sqlalchemy.pool import Pool
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from DatabaseConnection import DatabaseConnection
+from MultiDatabase import attach_databases
+from Snapshot import snapshot_connection_string, use_mmap
 
 
 '''
@@ -21,13 +23,23 @@ you will get a "table not found" error since you've created a new database.
 
 # Fill in database connection information here.
 sqlite_db = {
-	'name'	: 'Stars.sqlite' # this is the name of the file
+	'name'	: 'Stars.sqlite', # this is the name of the file
+	'snapshot'	: False, # True to open the read-only snapshot below instead (no locks, memory-mapped)
+	'snapshot_name'	: 'Stars_snapshot.sqlite' # the snapshot made by Snapshot.py; never the live database
 }
 
+# Other SQLite files to ATTACH to every connection, as schema alias --> filename,
+# e.g. {'ff': 'Stars_ffplugin.sqlite'}. Their tables are then available as ff.star etc.,
+# and unified all_<table> views over every file are created (see MultiDatabase.py).
+attached_db = {}
+
 # For more options of SQLite connection strings, see:
 # http://www.sqlalchemy.org/docs/reference/dialects/sqlite.html#connect-strings
 
-db_connection_string = "sqlite:///%s" % sqlite_db['name']
+if sqlite_db['snapshot']:
+	db_connection_string = snapshot_connection_string(sqlite_db['snapshot_name'])
+else:
+	db_connection_string = "sqlite:///%s" % sqlite_db['name']
 
 # ------------ Do not edit anything below this line! -------------------------
 
@@ -46,6 +58,12 @@ except:
 
 engine = db.engine
 
+if sqlite_db['snapshot']:
+	use_mmap(engine)
+
+if len(attached_db) > 0:
+	attach_databases(engine, attached_db)
+
 # SQLAlchemy has foreign key support starting with version 3.6.19.
 # However, it must be enabled every time a database is opened.
 # This code will do that.
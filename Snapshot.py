@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+"""
+Read-only snapshots of the star database for parallel analysis jobs.
+
+export_snapshot() writes a compacted copy of the database with an index on
+every foreign key column and on the name columns, fresh planner statistics
+(ANALYZE), and no journal. The file is written next to the target and then
+renamed over it, so readers that still have an older snapshot open keep
+reading the old file.
+
+Snapshots are opened with mode=ro&immutable=1, so SQLite takes no locks and
+never checks the file for changes, and with a large mmap_size, so every
+process reads the pages straight from the shared OS page cache:
+
+    engine = snapshot_engine('Stars_snapshot.sqlite')
+
+or set sqlite_db['snapshot'] = True in SQLiteConnection.py (which then opens
+sqlite_db['snapshot_name'] instead of the live database). Never write to a
+snapshot that is open: export a new one instead.
+
+Usage:
+    python Snapshot.py Stars.sqlite Stars_snapshot.sqlite
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sqlite3
+import stat
+
+from sqlalchemy import create_engine, event
+
+
+# Bytes of the database file to memory-map in every connection (more than the file size maps all of it)
+MMAP_SIZE = 2 ** 34
+
+# Columns to index besides the foreign keys, for lookups by name
+NAME_COLUMNS = {'star': ['name'],
+                'reference': ['bibcode'],
+                'cluster': ['name'],
+                'instrument': ['name']}
+
+
+def _add_indices(con):
+    """
+    Index every foreign key column and the NAME_COLUMNS that are not the first column of an index yet.
+    :return: the number of indices created
+    """
+    n_created = 0
+    tables = [r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                        "AND name NOT LIKE 'sqlite_%'")]
+    for table in tables:
+        indexed = set()
+        for index in con.execute('PRAGMA index_list("{}")'.format(table)).fetchall():
+            columns = con.execute('PRAGMA index_info("{}")'.format(index[1])).fetchall()
+            if len(columns) > 0:
+                indexed.add(sorted(columns)[0][2])
+        pk = [r[1] for r in con.execute('PRAGMA table_info("{}")'.format(table)) if r[5] == 1]
+        columns = [r[1] for r in con.execute('PRAGMA table_info("{}")'.format(table))]
+        wanted = [r[3] for r in con.execute('PRAGMA foreign_key_list("{}")'.format(table))]
+        wanted += [c for c in NAME_COLUMNS.get(table, []) if c in columns]
+        for column in wanted:
+            if column in indexed or column in pk[:1]:
+                continue
+            con.execute('CREATE INDEX "snapshot_{t}_{c}" ON "{t}" ("{c}")'.format(t=table, c=column))
+            indexed.add(column)
+            n_created += 1
+    return n_created
+
+
+def export_snapshot(source='Stars.sqlite', target='Stars_snapshot.sqlite'):
+    """
+    Write a compacted, fully indexed and analyzed read-only copy of a SQLite database.
+    :param source: the database file to copy
+    :param target: the snapshot file (replaced if it exists)
+    :return: the size of the snapshot in bytes
+    """
+    temporary = '{}.tmp'.format(target)
+    if os.path.exists(temporary):
+        os.remove(temporary)
+
+    con = sqlite3.connect(source)
+    try:
+        con.execute('VACUUM INTO ?', (temporary,))
+    finally:
+        con.close()
+
+    con = sqlite3.connect(temporary, isolation_level=None)
+    try:
+        n_indices = _add_indices(con)
+        con.execute('ANALYZE')
+        con.execute('PRAGMA journal_mode = DELETE')
+        # Compact again, now that the indices are there
+        con.execute('VACUUM')
+        integrity = con.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        con.close()
+    if integrity != 'ok':
+        os.remove(temporary)
+        raise RuntimeError('Integrity check of the snapshot failed: {}'.format(integrity))
+
+    os.chmod(temporary, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.rename(temporary, target)
+    size = os.path.getsize(target)
+    print('Wrote {} ({:.1f} MB, {} indices added)'.format(target, size / 1e6, n_indices))
+    return size
+
+
+def snapshot_connection_string(filename):
+    """
+    :return: the SQLAlchemy connection string that opens a snapshot read-only and without locking
+    """
+    return 'sqlite:///file:{}?mode=ro&immutable=1&uri=true'.format(filename)
+
+
+def use_mmap(engine, mmap_size=MMAP_SIZE):
+    """
+    Memory-map the database file (and refuse writes) in every new connection of the engine.
+    """
+    @event.listens_for(engine, 'connect')
+    def _mmap_on_connect(dbapi_con, connection_record):
+        dbapi_con.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+        dbapi_con.execute('PRAGMA query_only = ON')
+
+
+def snapshot_engine(filename='Stars_snapshot.sqlite', mmap_size=MMAP_SIZE):
+    """
+    :return: a sqlalchemy engine on a snapshot, for processes that do not use SQLiteConnection
+    """
+    engine = create_engine(snapshot_connection_string(filename))
+    use_mmap(engine, mmap_size)
+    return engine
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a read-only snapshot of the star database.')
+    parser.add_argument('source', nargs='?', default='Stars.sqlite', help='The database to copy')
+    parser.add_argument('target', nargs='?', default='Stars_snapshot.sqlite', help='The snapshot file to write')
+    args = parser.parse_args()
+
+    export_snapshot(args.source, args.target)
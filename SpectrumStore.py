@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+"""
+Packed, memory-mapped storage for the spectra behind the spectrum table.
+
+Spectra are grouped into containers (usually one per instrument and night).
+Each container is a pair of files in the store directory:
+
+    <group>.dat      raw float64 data. Every spectrum is stored as three
+                     consecutive blocks of n_pixels values: wavelength, flux, error
+    <group>.idx.npy  index with one (spectrum_id, offset, n_pixels) record per
+                     spectrum, where offset is counted in values from the start of <group>.dat
+
+The data files are memory-mapped, so loading a spectrum returns a (3, n_pixels)
+view into the page cache without copying or parsing anything:
+
+    wave, flux, err = spectrum.load()
+
+To fill the store from the original files, pass a function that reads one
+spectrum file to SpectrumStore.pack.
+"""
+
+from __future__ import print_function
+
+import glob
+import logging
+import os
+
+import numpy as np
+from sqlalchemy.orm import joinedload
+
+from ModelClasses import Spectrum, Observation
+
+
+# Fill in the store location here.
+store_directory = 'SpectrumStore'
+
+INDEX_DTYPE = np.dtype([('spectrum_id', np.int64), ('offset', np.int64), ('n_pixels', np.int64)])
+DATA_DTYPE = np.dtype(np.float64)
+
+
+def _group_name(spectrum):
+    """
+    Default container for a spectrum: <instrument>_<date> of its observation
+    """
+    observations = spectrum.observation
+    if len(observations) == 0:
+        return 'unassigned'
+    obs = observations[0]
+    instrument = obs.instrument.name if obs.instrument is not None and obs.instrument.name else 'unknown'
+    date = obs.date if obs.date else 'nodate'
+    return '{}_{}'.format(instrument, date).replace(' ', '').replace('/', '-')
+
+
+class SpectrumStore():
+    _instances = dict()
+
+    def __init__(self, directory=None):
+        """
+        :param directory: the directory holding the containers (created if needed).
+                          Defaults to the module-level store_directory.
+        """
+        self.directory = store_directory if directory is None else directory
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._data = dict()
+        self._index = dict()
+        self.refresh()
+
+    @classmethod
+    def default(cls):
+        """
+        :return: a shared store for the module-level store_directory
+        """
+        if store_directory not in cls._instances:
+            cls._instances[store_directory] = cls(store_directory)
+        return cls._instances[store_directory]
+
+    def _paths(self, group):
+        return (os.path.join(self.directory, '{}.dat'.format(group)),
+                os.path.join(self.directory, '{}.idx.npy'.format(group)))
+
+    def refresh(self):
+        """
+        (Re-)open every container in the store directory.
+        """
+        self._data = dict()
+        self._index = dict()
+        for index_file in sorted(glob.glob(os.path.join(self.directory, '*.idx.npy'))):
+            group = os.path.basename(index_file)[:-len('.idx.npy')]
+            data_file, _ = self._paths(group)
+            index = np.load(index_file)
+            if len(index) == 0 or os.path.getsize(data_file) == 0:
+                continue
+            self._open(group, index)
+
+    def _open(self, group, index):
+        """
+        (Re-)map the data file of one container and add the given index records of it.
+        """
+        data_file, _ = self._paths(group)
+        self._data[group] = np.memmap(data_file, dtype=DATA_DTYPE, mode='r')
+        for spectrum_id, offset, n_pixels in index:
+            self._index[int(spectrum_id)] = (group, int(offset), int(n_pixels))
+
+    def __contains__(self, spectrum_id):
+        return spectrum_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, spectrum_id):
+        """
+        :return: (3, n_pixels) read-only view with the wavelength, flux and error of the given spectrum
+        """
+        try:
+            group, offset, n_pixels = self._index[spectrum_id]
+        except KeyError:
+            raise KeyError('Spectrum {} is not in the spectrum store at {}'.format(spectrum_id, self.directory))
+        return self._data[group][offset:offset + 3 * n_pixels].reshape(3, n_pixels)
+
+    def add(self, spectrum_id, wavelength, flux, error=None, group='unassigned'):
+        """
+        Append one spectrum to a container. Spectra that are already in the store are not replaced.
+        :param spectrum_id: the id of the spectrum row
+        :param wavelength, flux, error: 1D arrays of the same length (error defaults to NaN)
+        :param group: the container to append to
+        """
+        self.add_many([(spectrum_id, wavelength, flux, error)], group=group)
+
+    def add_many(self, spectra, group='unassigned'):
+        """
+        Append several spectra to one container with a single write.
+        :param spectra: iterable of (spectrum_id, wavelength, flux, error) tuples
+        :param group: the container to append to
+        """
+        data_file, index_file = self._paths(group)
+        index = np.load(index_file) if os.path.exists(index_file) else np.zeros(0, dtype=INDEX_DTYPE)
+        offset = os.path.getsize(data_file) // DATA_DTYPE.itemsize if os.path.exists(data_file) else 0
+
+        records = []
+        with open(data_file, 'ab') as outfile:
+            for spectrum_id, wavelength, flux, error in spectra:
+                if spectrum_id in self._index:
+                    logging.warn('Spectrum {} is already in the spectrum store. Skipping'.format(spectrum_id))
+                    continue
+                wavelength = np.asarray(wavelength, dtype=DATA_DTYPE)
+                flux = np.asarray(flux, dtype=DATA_DTYPE)
+                error = np.full(wavelength.size, np.nan) if error is None else np.asarray(error, dtype=DATA_DTYPE)
+                if not (wavelength.size == flux.size == error.size):
+                    raise ValueError('Wavelength, flux and error arrays must be the same size!')
+                np.concatenate([wavelength, flux, error]).tofile(outfile)
+                records.append((spectrum_id, offset, wavelength.size))
+                offset += 3 * wavelength.size
+
+        if len(records) == 0:
+            return
+        records = np.array(records, dtype=INDEX_DTYPE)
+        np.save(index_file, np.concatenate([index, records]))
+        # Only this container changed, and the data file grew, so only it is mapped again
+        self._open(group, records)
+
+    def pack(self, session, reader, group_by=_group_name, chunk_size=100):
+        """
+        Copy every spectrum that is not in the store yet from its original file into the store.
+        :param session: a sqlalchemy session instance
+        :param reader: function taking a spectrum filename and returning (wavelength, flux, error)
+        :param group_by: function taking a Spectrum and returning the name of its container
+        :param chunk_size: the number of spectra to buffer before writing
+        :return: the number of spectra added
+        """
+        pending = dict()
+        n_added = 0
+        # The observations and instruments that the default group_by needs are loaded with the spectra
+        query = session.query(Spectrum).options(joinedload(Spectrum.observation).joinedload(Observation.instrument))
+        for spectrum in query.order_by(Spectrum.id):
+            if spectrum.id in self._index or spectrum.filename is None:
+                continue
+            wavelength, flux, error = reader(spectrum.filename)
+            pending.setdefault(group_by(spectrum), []).append((spectrum.id, wavelength, flux, error))
+            n_added += 1
+            if n_added % chunk_size == 0:
+                for group, spectra in pending.items():
+                    self.add_many(spectra, group=group)
+                pending = dict()
+        for group, spectra in pending.items():
+            self.add_many(spectra, group=group)
+        return n_added
+
+    def load_spectra(self, session, observation_ids):
+        """
+        Load the spectra of many observations, with one query per 500 observations.
+        :param session: a sqlalchemy session instance
+        :param observation_ids: iterable of observation ids
+        :return: dictionary of observation id --> (3, n_pixels) view (None if the observation has no stored spectrum)
+        """
+        observation_ids = list(observation_ids)
+        spectrum_ids = dict()
+        for i in range(0, len(observation_ids), 500):
+            chunk = observation_ids[i:i + 500]
+            spectrum_ids.update(session.query(Observation.id, Observation.spectrum_id)
+                                .filter(Observation.id.in_(chunk)).all())
+        return dict((obs_id, self.get(spectrum_ids[obs_id]) if spectrum_ids.get(obs_id) in self._index else None)
+                    for obs_id in observation_ids)
+
+
+def load_spectra(session, observation_ids, store=None):
+    """
+    Load the spectra of many observations from the default (or given) spectrum store.
+    See SpectrumStore.load_spectra
+    """
+    store = SpectrumStore.default() if store is None else store
+    return store.load_spectra(session, observation_ids)
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+
+"""
+Query helpers shared by the ingest scripts and the analysis code.
+"""
+
+from __future__ import print_function
+
+import logging
+
+import numpy as np
+import sqlalchemy
+
+from ModelClasses import Star, Reference, Star_Alias
+
+
+def get_reference(session, bibcode):
+    """
+    Return a reference object for the specified bibcode
+    """
+    try:
+        entry = session.query(Reference).filter(Reference.bibcode == bibcode).one()
+    except sqlalchemy.orm.exc.NoResultFound:
+        entry = Reference()
+        entry.bibcode = bibcode
+        session.add(entry)
+        session.flush()
+
+        #TODO: get author name, journal, volume, page, and year
+    return entry, session
+
+
+def normalize_name(name):
+    """
+    Normalize a star identifier for matching: upper case, with runs of whitespace collapsed.
+    'HR  1092' and 'hr 1092' both become 'HR 1092'.
+    """
+    return ' '.join(name.split()).upper()
+
+
+def alias_catalog(name):
+    """
+    The catalog an identifier comes from: 'HD 1234' --> 'HD', '2MASS J01234567+0123456' --> '2MASS'
+    """
+    name = normalize_name(name)
+    return name.split()[0] if ' ' in name else None
+
+
+def create_alias_table(engine):
+    """
+    Create the star_alias table and its indices if they do not exist yet.
+    """
+    Star_Alias.__table__.create(bind=engine, checkfirst=True)
+
+
+def _has_alias_table(session):
+    connection = session.connection()
+    return connection.dialect.has_table(connection, Star_Alias.__tablename__)
+
+
+def _create_missing_alias_table(session):
+    """
+    Create the star_alias table on the session's connection (so inside its transaction) if it does not exist yet.
+    """
+    if not _has_alias_table(session):
+        Star_Alias.__table__.create(bind=session.connection())
+
+
+def add_aliases(session, star_id, names, chunk_size=500):
+    """
+    Add identifiers for a star to the alias table. Names that are already known are skipped
+    (with a warning if they point to a different star).
+    :param star_id: the id of the star
+    :param names: iterable of identifiers (e.g. the SIMBAD main id and the IDS list)
+    :return: the number of aliases added
+    """
+    _create_missing_alias_table(session)
+    aliases = dict()
+    for name in names:
+        if name is not None and len(name.strip()) > 0:
+            aliases.setdefault(normalize_name(name), name.strip())
+    known = resolve_names(session, list(aliases.values()), chunk_size=chunk_size)
+    rows = []
+    for key, name in aliases.items():
+        if known[name] is None:
+            rows.append({'star_id': star_id, 'alias': name, 'key': key, 'catalog': alias_catalog(name)})
+        elif known[name] != star_id:
+            logging.warn('Alias {} already belongs to star {}, not {}. Skipping'.format(name, known[name], star_id))
+    for i in range(0, len(rows), chunk_size):
+        session.execute(Star_Alias.__table__.insert(), rows[i:i + chunk_size])
+    return len(rows)
+
+
+def add_star_names(session, chunk_size=500):
+    """
+    Make sure the name of every star in the database is in the alias table.
+    :return: the number of aliases added
+    """
+    _create_missing_alias_table(session)
+    known = set(k for k, in session.query(Star_Alias.key))
+    rows = []
+    for star_id, name in session.query(Star.id, Star.name).filter(Star.name != None):
+        key = normalize_name(name)
+        if key not in known:
+            known.add(key)
+            rows.append({'star_id': star_id, 'alias': name, 'key': key, 'catalog': alias_catalog(name)})
+    for i in range(0, len(rows), chunk_size):
+        session.execute(Star_Alias.__table__.insert(), rows[i:i + chunk_size])
+    return len(rows)
+
+
+def resolve_names(session, names, chunk_size=500):
+    """
+    Look up the star ids of many identifiers at once, using the alias table.
+    :param names: iterable of identifiers, in any catalog known to the alias table
+    :return: dictionary of name --> star id (None if the name is not known, or if there is no alias table yet)
+    """
+    names = list(names)
+    if not _has_alias_table(session):
+        return dict((name, None) for name in names)
+    keys = dict((name, normalize_name(name)) for name in names)
+    unique_keys = sorted(set(keys.values()))
+    ids = dict()
+    for i in range(0, len(unique_keys), chunk_size):
+        chunk = unique_keys[i:i + chunk_size]
+        ids.update(session.query(Star_Alias.key, Star_Alias.star_id).filter(Star_Alias.key.in_(chunk)).all())
+    return dict((name, ids.get(keys[name])) for name in names)
+
+
+def match_catalog(session, names=None, ra=None, dec=None, tolerance=2.0):
+    """
+    Match the rows of an external catalog to the stars in the database: by identifier, through the
+    alias table, and then by position for the stars that no identifier matched.
+    :param names: optional sequence of catalog identifiers, one per row
+    :param ra, dec: optional sequences of J2000 positions in degrees, one per row (star.RA is in hours)
+    :param tolerance: the largest separation for a match by position, in arcsec
+    :return: dictionary of star id --> index of the catalog row (the first row matching by name,
+             otherwise the nearest one)
+    """
+    matches = dict()
+    if names is not None:
+        names = [str(name) for name in names]
+        star_ids = resolve_names(session, names)
+        for i, name in enumerate(names):
+            star_id = star_ids[name]
+            if star_id is not None and star_id not in matches:
+                matches[star_id] = i
+    if ra is None or dec is None:
+        return matches
+
+    ra = np.radians(np.ma.filled(np.ma.asarray(ra, dtype=np.float64), np.nan))
+    dec = np.radians(np.ma.filled(np.ma.asarray(dec, dtype=np.float64), np.nan))
+    order = np.argsort(dec, kind='mergesort')
+    sorted_dec = dec[order]
+    radius = np.radians(tolerance / 3600.0)
+    for star_id, star_ra, star_dec in session.query(Star.id, Star.RA, Star.DEC) \
+            .filter(Star.RA != None, Star.DEC != None):
+        if star_id in matches:
+            continue
+        star_ra, star_dec = np.radians(star_ra * 15.0), np.radians(star_dec)
+        # Only the catalog rows in a declination strip around the star can be close enough
+        rows = np.sort(order[np.searchsorted(sorted_dec, star_dec - radius):
+                             np.searchsorted(sorted_dec, star_dec + radius, side='right')])
+        if len(rows) == 0:
+            continue
+        hav = np.sin((dec[rows] - star_dec) / 2) ** 2 + \
+            np.cos(star_dec) * np.cos(dec[rows]) * np.sin((ra[rows] - star_ra) / 2) ** 2
+        separation = 2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+        nearest = np.argmin(separation)
+        if separation[nearest] <= radius:
+            matches[star_id] = int(rows[nearest])
+    return matches
+
+
+def get_references(session, bibcodes, chunk_size=500):
+    """
+    Bulk version of get_reference. Missing references are created with one INSERT per chunk.
+    :param session: a sqlalchemy session instance
+    :param bibcodes: iterable of bibcodes
+    :return: dictionary of bibcode --> reference id
+    """
+    bibcodes = sorted(set(bibcodes))
+    ids = dict()
+    for i in range(0, len(bibcodes), chunk_size):
+        chunk = bibcodes[i:i + chunk_size]
+        ids.update(session.query(Reference.bibcode, Reference.id).filter(Reference.bibcode.in_(chunk)).all())
+    missing = [b for b in bibcodes if b not in ids]
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        session.execute(Reference.__table__.insert(), [{'bibcode': b} for b in chunk])
+        ids.update(session.query(Reference.bibcode, Reference.id).filter(Reference.bibcode.in_(chunk)).all())
+    return ids
+
+
+def iter_stars(session, chunk_size=1000, columns=None, filters=()):
+    """
+    Iterate over the stars in the database in chunks, using keyset pagination on star.id.
+
+    When whole Star objects are returned, every chunk is flushed and then expunged from the
+    session before the next one is loaded, so the identity map never holds more than chunk_size
+    stars. Changes made to a star must therefore be made before moving on to the next chunk.
+
+    :param session: a sqlalchemy session instance
+    :param chunk_size: the number of stars to load per query
+    :param columns: an optional list of column names (or Star attributes). If given, plain
+                    row tuples with (id, column1, column2, ...) are returned instead of Star objects.
+    :param filters: optional sqlalchemy filter expressions (e.g. Star.cluster_id == 3)
+    :return: generator of Star objects or row tuples, ordered by star id
+    """
+    if columns is not None:
+        columns = [getattr(Star, c) if isinstance(c, str) else c for c in columns]
+        base = session.query(Star.id, *columns)
+    else:
+        base = session.query(Star)
+    base = base.filter(*filters)
+
+    last_id = None
+    while True:
+        chunk_query = base if last_id is None else base.filter(Star.id > last_id)
+        chunk = chunk_query.order_by(Star.id).limit(chunk_size).all()
+        if len(chunk) == 0:
+            return
+
+        for item in chunk:
+            yield item
+
+        last_id = chunk[-1][0] if columns is not None else chunk[-1].id
+        if columns is None:
+            session.flush()
+            for star in chunk:
+                if star in session:
+                    session.expunge(star)
+        if len(chunk) < chunk_size:
+            return
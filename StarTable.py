@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+"""
+Compact, read-only star data for pipelines that do not change the database.
+
+A Star object carries every column plus instance state and relationship
+descriptors. A StarTable holds the same data as one numpy array per column
+(struct of arrays), so a star costs only the bytes of its values:
+
+    int64 for integer columns (NULL foreign keys become NULL_ID),
+    float64 for other numbers (NULL becomes NaN),
+    fixed-width unicode for text (NULL becomes '').
+
+Loading goes through Core queries in chunks and never creates ORM objects.
+Rows are available as namedtuple records, and the *_ref_id columns are
+resolved to bibcodes lazily (one query per new batch of reference ids):
+
+    table = load_star_table(session, columns=['name', 'vsini', 'vsini_ref_id'],
+                            filters=[Star.vsini > 100])
+    fast = table[table['vsini'] > 300]          # another StarTable
+    star = table[0]                             # StarRecord(id=1, name='HR  1092', vsini=249.0, ...)
+    bibcodes = table.references('vsini')        # array of bibcodes, aligned with the rows
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from sqlalchemy import select
+
+from ModelClasses import Star, Reference
+
+
+NULL_ID = -1
+
+_record_types = dict()
+
+
+def record_type(names):
+    """
+    :return: the namedtuple class for star records with the given column names
+    """
+    names = tuple(names)
+    if names not in _record_types:
+        _record_types[names] = namedtuple('StarRecord', names)
+    return _record_types[names]
+
+
+def column_array(column, values):
+    """
+    Convert the values of one star column to a compact numpy array.
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = str
+    if python_type is int:
+        return np.array([NULL_ID if v is None else v for v in values], dtype=np.int64)
+    if python_type is float:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array(['' if v is None else v for v in values], dtype=np.str_)
+
+
+class ReferenceResolver():
+    def __init__(self, sql_session, chunk_size=500):
+        """
+        Look up reference bibcodes by id, remembering every one it has seen.
+        :param sql_session: a sqlalchemy session instance
+        """
+        self.sql_session = sql_session
+        self.chunk_size = chunk_size
+        self._bibcodes = {NULL_ID: ''}
+
+    def bibcodes(self, reference_ids):
+        """
+        :param reference_ids: array of reference ids (NULL_ID for no reference)
+        :return: array of bibcodes ('' for no reference)
+        """
+        reference_ids = np.asarray(reference_ids, dtype=np.int64)
+        unique = np.unique(reference_ids)
+        missing = [int(i) for i in unique if int(i) not in self._bibcodes]
+        for i in range(0, len(missing), self.chunk_size):
+            chunk = missing[i:i + self.chunk_size]
+            found = dict(self.sql_session.query(Reference.id, Reference.bibcode).filter(Reference.id.in_(chunk)))
+            self._bibcodes.update((ref_id, found.get(ref_id) or '') for ref_id in chunk)
+        lookup = np.array([self._bibcodes[int(i)] for i in unique], dtype=np.str_)
+        return lookup[np.searchsorted(unique, reference_ids)] if len(unique) > 0 else np.zeros(0, dtype=np.str_)
+
+
+class StarTable():
+    def __init__(self, columns, resolver=None):
+        """
+        :param columns: OrderedDict of column name --> numpy array, all the same length and including 'id'
+        :param resolver: a ReferenceResolver, for references()
+        """
+        self.columns = OrderedDict(columns)
+        self.resolver = resolver
+        self._record = record_type(self.columns)
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns.values())
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __contains__(self, star_id):
+        return len(self.index(star_id)) > 0
+
+    def __getitem__(self, key):
+        """
+        table['vsini'] --> the vsini column
+        table[5]       --> the 6th row, as a StarRecord
+        table[mask], table[indices], table[2:10] --> a StarTable with those rows
+        """
+        if isinstance(key, str):
+            return self.columns[key]
+        if isinstance(key, (int, np.integer)):
+            return self._record(*[values[key].item() for values in self.columns.values()])
+        return StarTable(OrderedDict((name, values[key]) for name, values in self.columns.items()), self.resolver)
+
+    def __iter__(self):
+        for row in zip(*[values.tolist() for values in self.columns.values()]):
+            yield self._record(*row)
+
+    def index(self, star_ids):
+        """
+        :return: the row numbers of the given star ids (ids that are not in the table are left out)
+        """
+        star_ids = np.atleast_1d(np.asarray(star_ids, dtype=np.int64))
+        order = np.argsort(self.columns['id'], kind='mergesort')
+        sorted_ids = self.columns['id'][order]
+        pos = np.clip(np.searchsorted(sorted_ids, star_ids), 0, max(len(sorted_ids) - 1, 0))
+        found = (sorted_ids[pos] == star_ids) if len(sorted_ids) > 0 else np.zeros(len(star_ids), dtype=bool)
+        return order[pos[found]]
+
+    def star(self, star_id):
+        """
+        :return: the StarRecord of one star id
+        """
+        rows = self.index(star_id)
+        if len(rows) == 0:
+            raise KeyError('Star {} is not in this table'.format(star_id))
+        return self[int(rows[0])]
+
+    def references(self, quantity):
+        """
+        Resolve the reference of a quantity for every row.
+        :param quantity: e.g. 'vsini' (the table must have the vsini_ref_id column)
+        :return: array of bibcodes ('' where there is no reference)
+        """
+        if self.resolver is None:
+            raise ValueError('This star table has no reference resolver. Load it with a session.')
+        return self.resolver.bibcodes(self.columns['{}_ref_id'.format(quantity)])
+
+    def to_records(self):
+        """
+        :return: the table as a numpy structured array
+        """
+        records = np.empty(len(self), dtype=[(name, values.dtype) for name, values in self.columns.items()])
+        for name, values in self.columns.items():
+            records[name] = values
+        return records
+
+
+def _star_columns(columns):
+    """
+    :return: the star table columns to load: id first, then the given names (default: all of them)
+    """
+    table = Star.__table__
+    if columns is None:
+        names = [c.name for c in table.columns]
+    else:
+        names = ['id'] + [name for name in (c if isinstance(c, str) else c.key for c in columns) if name != 'id']
+    return [table.c[name] for name in names]
+
+
+def _chunks(session, columns, filters, chunk_size):
+    """
+    Yield lists of row tuples in star id order, using keyset pagination on star.id.
+    """
+    star_id = Star.__table__.c.id
+    last_id = None
+    while True:
+        statement = select(columns).where(star_id > last_id) if last_id is not None else select(columns)
+        for condition in filters:
+            statement = statement.where(condition)
+        rows = session.execute(statement.order_by(star_id).limit(chunk_size)).fetchall()
+        if len(rows) == 0:
+            return
+        yield rows
+        last_id = rows[-1][0]
+        if len(rows) < chunk_size:
+            return
+
+
+def load_star_table(session, columns=None, filters=(), chunk_size=10000):
+    """
+    Load stars into a StarTable without creating ORM objects.
+    :param session: a sqlalchemy session instance
+    :param columns: optional list of column names (or Star attributes); id is always included
+    :param filters: optional sqlalchemy filter expressions (e.g. Star.cluster_id == 3)
+    :param chunk_size: the number of stars per query
+    :return: a StarTable, ordered by star id
+    """
+    columns = _star_columns(columns)
+    pieces = [[] for _ in columns]
+    for rows in _chunks(session, columns, filters, chunk_size):
+        for k, column in enumerate(columns):
+            pieces[k].append(column_array(column, [row[k] for row in rows]))
+    arrays = OrderedDict()
+    for column, piece in zip(columns, pieces):
+        arrays[column.name] = np.concatenate(piece) if len(piece) > 0 else column_array(column, [])
+    return StarTable(arrays, resolver=ReferenceResolver(session))
+
+
+def iter_star_records(session, columns=None, filters=(), chunk_size=10000):
+    """
+    Iterate over stars as read-only StarRecord namedtuples, without creating ORM objects.
+    Arguments are the same as for load_star_table.
+    """
+    columns = _star_columns(columns)
+    record = record_type(c.name for c in columns)
+    for rows in _chunks(session, columns, filters, chunk_size):
+        for row in rows:
+            yield record(*row)
@@ -74,3 +74,83 @@ CREATE TABLE "ccf" ("id" INTEGER PRIMARY KEY  AUTOINCREMENT  NOT NULL  UNIQUE ,
 
 DROP TABLE IF EXISTS "observation";
 CREATE TABLE "observation" ("id" INTEGER PRIMARY KEY  AUTOINCREMENT  NOT NULL  UNIQUE , "instrument_id" INTEGER, "date" TEXT, "star_id" INTEGER, "spectrum_id" INTEGER, "ccf_id" INTEGER, "notes" TEXT, FOREIGN KEY (instrument_id) REFERENCES instrument (id), FOREIGN KEY (star_id) REFERENCES star (id), FOREIGN KEY (spectrum_id) REFERENCES spectrum (id), FOREIGN KEY (ccf_id) REFERENCES ccf (id));
+
+
+DROP VIEW IF EXISTS "star_view";
+DROP TABLE IF EXISTS "measurement";
+CREATE TABLE "measurement" ("id" INTEGER PRIMARY KEY  AUTOINCREMENT  NOT NULL  UNIQUE, "star_id" INTEGER NOT NULL, "quantity" TEXT NOT NULL,
+                            "value" FLOAT, "text_value" TEXT, "error" FLOAT, "reference_id" INTEGER, "epoch" FLOAT,
+                            FOREIGN KEY (star_id) REFERENCES star (id),
+                            FOREIGN KEY (reference_id) REFERENCES reference (id));
+CREATE INDEX "measurement_quantity_reference" ON "measurement" ("quantity", "reference_id", "star_id", "value", "error");
+CREATE INDEX "measurement_star_quantity" ON "measurement" ("star_id", "quantity", "epoch");
+
+CREATE VIEW star_view AS SELECT s."id",
+  s."name",
+  s."cluster_id",
+  s."component",
+  m_spectral_type.text_value AS "spectral_type",
+  m_spectral_type.reference_id AS "spectral_type_ref_id",
+  m_temperature.value AS "temperature",
+  m_temperature.error AS "temperature_error",
+  m_temperature.reference_id AS "temperature_ref_id",
+  m_logg.value AS "logg",
+  m_logg.error AS "logg_error",
+  m_logg.reference_id AS "logg_ref_id",
+  m_mass.value AS "mass",
+  m_mass.error AS "mass_error",
+  m_mass.reference_id AS "mass_ref_id",
+  m_metallicity.value AS "metallicity",
+  m_metallicity.error AS "metallicity_error",
+  m_metallicity.reference_id AS "metallicity_ref_id",
+  m_radius.value AS "radius",
+  m_radius.error AS "radius_error",
+  m_radius.reference_id AS "radius_ref_id",
+  m_vsini.value AS "vsini",
+  m_vsini.error AS "vsini_error",
+  m_vsini.reference_id AS "vsini_ref_id",
+  m_vsys.value AS "vsys",
+  m_vsys.error AS "vsys_error",
+  m_vsys.reference_id AS "vsys_ref_id",
+  m_parallax.value AS "parallax",
+  m_parallax.error AS "parallax_error",
+  m_parallax.reference_id AS "parallax_ref_id",
+  m_Vmag.value AS "Vmag",
+  m_Vmag.error AS "Vmag_error",
+  m_Vmag.reference_id AS "Vmag_ref_id",
+  m_Kmag.value AS "Kmag",
+  m_Kmag.error AS "Kmag_error",
+  m_Kmag.reference_id AS "Kmag_ref_id",
+  s."RA",
+  s."DEC" FROM star s
+LEFT JOIN measurement m_spectral_type ON m_spectral_type.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'spectral_type' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_temperature ON m_temperature.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'temperature' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_logg ON m_logg.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'logg' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_mass ON m_mass.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'mass' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_metallicity ON m_metallicity.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'metallicity' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_radius ON m_radius.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'radius' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_vsini ON m_vsini.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'vsini' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_vsys ON m_vsys.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'vsys' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_parallax ON m_parallax.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'parallax' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_Vmag ON m_Vmag.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'Vmag' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1)
+LEFT JOIN measurement m_Kmag ON m_Kmag.id = (SELECT m.id FROM measurement m WHERE m.star_id = s.id AND m.quantity = 'Kmag' ORDER BY COALESCE(m.epoch, 0) DESC, m.id DESC LIMIT 1);
+
+DROP TABLE IF EXISTS "star_alias";
+CREATE TABLE "star_alias" ("id" INTEGER PRIMARY KEY  AUTOINCREMENT  NOT NULL  UNIQUE, "star_id" INTEGER NOT NULL,
+                           "alias" TEXT NOT NULL, "key" TEXT NOT NULL, "catalog" TEXT,
+                           FOREIGN KEY (star_id) REFERENCES star (id));
+CREATE UNIQUE INDEX "star_alias_key" ON "star_alias" ("key");
+CREATE INDEX "star_alias_star" ON "star_alias" ("star_id");
+
+DROP TABLE IF EXISTS "cluster_summary";
+CREATE TABLE "cluster_summary" ("cluster_id" INTEGER PRIMARY KEY NOT NULL, "n_stars" INTEGER NOT NULL,
+                                "n_systems" INTEGER NOT NULL, "n_multiple" INTEGER NOT NULL);
+
+DROP TABLE IF EXISTS "spectral_class_summary";
+CREATE TABLE "spectral_class_summary" ("spectral_class" TEXT NOT NULL, "vsini_bin" FLOAT NOT NULL,
+                                       "n_stars" INTEGER NOT NULL, "vsini_sum" FLOAT,
+                                       PRIMARY KEY ("spectral_class", "vsini_bin"));
+
+DROP TABLE IF EXISTS "instrument_summary";
+CREATE TABLE "instrument_summary" ("instrument_id" INTEGER PRIMARY KEY NOT NULL, "n_observations" INTEGER NOT NULL,
+                                   "n_stars" INTEGER NOT NULL, "n_spectra" INTEGER NOT NULL, "n_ccfs" INTEGER NOT NULL);
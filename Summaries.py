@@ -0,0 +1,333 @@
+#!/usr/bin/python
+
+"""
+Materialized summary tables for sample statistics.
+
+    cluster_summary          stars, star systems and multiple systems per cluster
+    spectral_class_summary   stars and the sum of their vsini per spectral class
+                             and vsini bin (VSINI_BIN_WIDTH wide, -1 for no vsini)
+    instrument_summary       observations, stars, spectra and CCFs per instrument
+
+Stars without a cluster and observations without an instrument are counted
+under id 0. A star system is multiple if it has more than one star, or if it
+takes part in a configuration.
+
+Every flush of a tracked session factory (see track_sessions; the one of
+DatabaseConnection is tracked on import) records the clusters, spectral
+classes, instruments and star systems that it touches, and
+refresh_summaries() recomputes only those groups, with one GROUP BY
+statement per summary table. Core INSERT/UPDATE/
+DELETE statements (e.g. the bulk stellar parameter update) mark the whole
+summary stale instead, as do calls to mark_stale(). The query functions at
+the bottom read only the summary tables, so they cost O(groups).
+
+Usage:
+    create_summary_tables(engine)
+    refresh_summaries(session)             # after an ingest stage (done by fill_db)
+    refresh_summaries(session, full=True)  # rebuild everything
+    binary_fraction(session)
+    vsini_above(session, 150)
+"""
+
+from __future__ import print_function
+
+import threading
+
+from sqlalchemy import event, inspect, text, bindparam, func, case
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+
+from DatabaseConnection import DatabaseConnection
+from ModelClasses import Star, Star_System, Star_to_Star_System, Configuration, Observation, Cluster, \
+    Instrument, Cluster_Summary, Spectral_Class_Summary, Instrument_Summary
+
+
+SUMMARIES = ('cluster', 'spectral_class', 'instrument')
+_TABLES = {'cluster': Cluster_Summary, 'spectral_class': Spectral_Class_Summary, 'instrument': Instrument_Summary}
+VSINI_BIN_WIDTH = 10.0
+
+# The summaries that depend on each table, for Core statements whose rows are unknown
+_DEPENDS = {'star': ('cluster', 'spectral_class'),
+            'star_system': ('cluster',),
+            'star_to_star_system': ('cluster',),
+            'configuration': ('cluster',),
+            'observation': ('instrument',)}
+
+# Groups (and star systems) that changed since the last refresh, and summaries that need a full refresh
+_pending = {'cluster': set(), 'spectral_class': set(), 'instrument': set(), 'system': set()}
+_stale = set()
+_lock = threading.Lock()
+_flushing = threading.local()
+_tracked = []
+
+
+def spectral_class(spectral_type):
+    """
+    The spectral class of a spectral type: 'B9.5V' --> 'B'. Unknown spectral types give ''.
+    """
+    return '' if spectral_type is None else spectral_type.strip()[:1].upper()
+
+
+def mark_stale(*summaries):
+    """
+    Make the next refresh_summaries() rebuild the given summaries (default: all of them).
+    Call this after writing to the tables with raw SQL strings.
+    """
+    with _lock:
+        _stale.update(summaries if len(summaries) > 0 else SUMMARIES)
+
+
+def _values(obj, attribute):
+    """
+    :return: the old and new values of an attribute of a flushed object
+    """
+    values = list(inspect(obj).attrs[attribute].history.sum())
+    # An attribute that was never set on a new object is NULL
+    return values if len(values) > 0 else [None]
+
+
+def _start_flush(session, flush_context, instances):
+    _flushing.active = True
+
+
+def _record_groups(session, flush_context):
+    groups = dict((name, set()) for name in _pending)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Star):
+            groups['cluster'].update(0 if c is None else c for c in _values(obj, 'cluster_id'))
+            groups['spectral_class'].update(spectral_class(s) for s in _values(obj, 'spectral_type'))
+        elif isinstance(obj, Star_System):
+            groups['system'].add(obj.id)
+        elif isinstance(obj, Star_to_Star_System):
+            groups['system'].update(_values(obj, 'star_system_id'))
+        elif isinstance(obj, Configuration):
+            groups['system'].update(_values(obj, 'star_system1_id') + _values(obj, 'star_system2_id'))
+        elif isinstance(obj, Observation):
+            groups['instrument'].update(0 if i is None else i for i in _values(obj, 'instrument_id'))
+    with _lock:
+        for name, values in groups.items():
+            _pending[name].update(v for v in values if v is not None)
+
+
+def _end_flush(session, *args):
+    # Also called on rollback, so that a failed flush does not leave the flag set
+    _flushing.active = False
+
+
+def track_sessions(session_factory):
+    """
+    Record the groups that change in every flush of the sessions made by session_factory
+    (a sessionmaker or scoped_session), for the next refresh_summaries().
+    """
+    if any(f is session_factory for f in _tracked):
+        return
+    _tracked.append(session_factory)
+    event.listen(session_factory, 'before_flush', _start_flush)
+    event.listen(session_factory, 'after_flush', _record_groups)
+    event.listen(session_factory, 'after_flush_postexec', _end_flush)
+    event.listen(session_factory, 'after_soft_rollback', _end_flush)
+
+
+@event.listens_for(Engine, 'after_execute')
+def _record_core_writes(conn, clauseelement, multiparams, params, result):
+    if isinstance(clauseelement, UpdateBase) and not getattr(_flushing, 'active', False):
+        mark_stale(*_DEPENDS.get(clauseelement.table.name, ()))
+
+
+track_sessions(DatabaseConnection().Session)
+
+
+def create_summary_tables(engine):
+    """
+    Create the summary tables if they do not exist yet. The next refresh_summaries() rebuilds them.
+    """
+    for cls in _TABLES.values():
+        cls.__table__.create(bind=engine, checkfirst=True)
+    mark_stale()
+
+
+def _create_missing_tables(session):
+    """
+    Create the summary tables that do not exist yet, on the session's connection, and mark them stale.
+    """
+    connection = session.connection()
+    for name, cls in _TABLES.items():
+        if not connection.dialect.has_table(connection, cls.__tablename__):
+            cls.__table__.create(bind=connection)
+            mark_stale(name)
+
+
+_CLUSTER_SQL = """
+INSERT INTO cluster_summary (cluster_id, n_stars, n_systems, n_multiple)
+SELECT COALESCE(s.cluster_id, 0), COUNT(DISTINCT s.id), COUNT(DISTINCT m.star_system_id),
+       COUNT(DISTINCT CASE WHEN multiple.id IS NOT NULL THEN m.star_system_id END)
+FROM star s
+LEFT JOIN star_to_star_system m ON m.star_id = s.id
+LEFT JOIN (SELECT star_system_id AS id FROM star_to_star_system GROUP BY star_system_id HAVING COUNT(*) > 1
+           UNION SELECT star_system1_id FROM configuration
+           UNION SELECT star_system2_id FROM configuration) multiple ON multiple.id = m.star_system_id
+{where}
+GROUP BY 1
+"""
+
+_SYSTEM_CLUSTERS_SQL = """
+SELECT DISTINCT COALESCE(s.cluster_id, 0) FROM star s JOIN star_to_star_system m ON m.star_id = s.id
+WHERE m.star_system_id IN :groups
+"""
+
+_SPECTRAL_CLASS = "COALESCE(UPPER(SUBSTR(TRIM(spectral_type), 1, 1)), '')"
+
+_SPECTRAL_CLASS_SQL = """
+INSERT INTO spectral_class_summary (spectral_class, vsini_bin, n_stars, vsini_sum)
+SELECT {spectral_class}, COALESCE({vsini_bin}, -1), COUNT(*), SUM(vsini) FROM star
+{where}
+GROUP BY 1, 2
+"""
+
+_INSTRUMENT_SQL = """
+INSERT INTO instrument_summary (instrument_id, n_observations, n_stars, n_spectra, n_ccfs)
+SELECT COALESCE(instrument_id, 0), COUNT(*), COUNT(DISTINCT star_id), COUNT(DISTINCT spectrum_id),
+       COUNT(DISTINCT ccf_id) FROM observation
+{where}
+GROUP BY 1
+"""
+
+
+def _rebuild(session, table, key, insert_sql, group_expression, groups, chunk_size=500):
+    """
+    Delete and recompute the rows of a summary table for the given groups (every row if groups is None).
+    """
+    if groups is None:
+        session.execute(text('DELETE FROM {}'.format(table)))
+        session.execute(text(insert_sql.format(where='')))
+        return
+    groups = sorted(groups)
+    for i in range(0, len(groups), chunk_size):
+        chunk = {'groups': groups[i:i + chunk_size]}
+        session.execute(text('DELETE FROM {} WHERE {} IN :groups'.format(table, key))
+                        .bindparams(bindparam('groups', expanding=True)), chunk)
+        session.execute(text(insert_sql.format(where='WHERE {} IN :groups'.format(group_expression)))
+                        .bindparams(bindparam('groups', expanding=True)), chunk)
+
+
+def _refresh_cluster(session, groups):
+    if groups is not None:
+        clusters, systems = set(groups[0]), sorted(groups[1])
+        for i in range(0, len(systems), 500):
+            statement = text(_SYSTEM_CLUSTERS_SQL).bindparams(bindparam('groups', expanding=True))
+            clusters.update(row[0] for row in session.execute(statement, {'groups': systems[i:i + 500]}))
+        groups = clusters
+    _rebuild(session, 'cluster_summary', 'cluster_id', _CLUSTER_SQL, 'COALESCE(s.cluster_id, 0)', groups)
+
+
+def _refresh_spectral_class(session, groups):
+    if session.get_bind().dialect.name == 'sqlite':
+        # vsini is never negative, so truncating is the same as rounding down
+        vsini_bin = 'CAST(vsini / {w} AS INTEGER) * {w}'.format(w=VSINI_BIN_WIDTH)
+    else:
+        vsini_bin = 'FLOOR(vsini / {w}) * {w}'.format(w=VSINI_BIN_WIDTH)
+    insert_sql = _SPECTRAL_CLASS_SQL.replace('{spectral_class}', _SPECTRAL_CLASS).replace('{vsini_bin}', vsini_bin)
+    _rebuild(session, 'spectral_class_summary', 'spectral_class', insert_sql, _SPECTRAL_CLASS, groups)
+
+
+def _refresh_instrument(session, groups):
+    _rebuild(session, 'instrument_summary', 'instrument_id', _INSTRUMENT_SQL, 'COALESCE(instrument_id, 0)', groups)
+
+
+def refresh_summaries(session, full=False):
+    """
+    Bring the summary tables up to date, recomputing only the groups that changed since the last refresh.
+    Summary tables that do not exist yet are created (and filled).
+    :param full: rebuild every summary table from scratch
+    :return: dictionary of summary --> 'full', the number of groups refreshed, or 0
+    """
+    session.flush()
+    _create_missing_tables(session)
+    with _lock:
+        pending = dict((name, set(values)) for name, values in _pending.items())
+        stale = set(SUMMARIES) if full else set(_stale)
+        for values in _pending.values():
+            values.clear()
+        _stale.clear()
+
+    try:
+        report = dict()
+        for name, refresh, groups in [('cluster', _refresh_cluster, (pending['cluster'], pending['system'])),
+                                      ('spectral_class', _refresh_spectral_class, pending['spectral_class']),
+                                      ('instrument', _refresh_instrument, pending['instrument'])]:
+            if name in stale:
+                refresh(session, None)
+                report[name] = 'full'
+            elif name == 'cluster' and len(groups[0]) + len(groups[1]) > 0:
+                refresh(session, groups)
+                report[name] = len(groups[0]) + len(groups[1])
+            elif name != 'cluster' and len(groups) > 0:
+                refresh(session, groups)
+                report[name] = len(groups)
+            else:
+                report[name] = 0
+    except:
+        # Keep the changes pending, so that the next refresh still sees them
+        with _lock:
+            for name, values in pending.items():
+                _pending[name].update(values)
+            _stale.update(stale)
+        raise
+    return report
+
+
+# ----------------------------------------------------------------
+# Queries. These only read the summary tables.
+# ----------------------------------------------------------------
+def cluster_statistics(session):
+    """
+    :return: list of (cluster id, cluster name, n_stars, n_systems, n_multiple) tuples.
+             Stars that are not in a cluster have cluster id 0 and name None.
+    """
+    return session.query(Cluster_Summary.cluster_id, Cluster.name, Cluster_Summary.n_stars,
+                         Cluster_Summary.n_systems, Cluster_Summary.n_multiple) \
+        .outerjoin(Cluster, Cluster.id == Cluster_Summary.cluster_id).order_by(Cluster_Summary.cluster_id).all()
+
+
+def binary_fraction(session):
+    """
+    :return: dictionary of cluster id --> fraction of its star systems that are multiple
+    """
+    return dict((cluster_id, float(n_multiple) / n_systems if n_systems > 0 else float('nan'))
+                for cluster_id, n_systems, n_multiple in
+                session.query(Cluster_Summary.cluster_id, Cluster_Summary.n_systems, Cluster_Summary.n_multiple))
+
+
+def spectral_class_statistics(session):
+    """
+    :return: list of (spectral class, n_stars, number of stars with a vsini, mean vsini) tuples
+    """
+    n_vsini = func.sum(case([(Spectral_Class_Summary.vsini_bin >= 0, Spectral_Class_Summary.n_stars)], else_=0))
+    rows = session.query(Spectral_Class_Summary.spectral_class, func.sum(Spectral_Class_Summary.n_stars), n_vsini,
+                         func.sum(Spectral_Class_Summary.vsini_sum)) \
+        .group_by(Spectral_Class_Summary.spectral_class).order_by(Spectral_Class_Summary.spectral_class).all()
+    return [(cls, n, n_v, vsini_sum / n_v if n_v else None) for cls, n, n_v, vsini_sum in rows]
+
+
+def vsini_above(session, threshold):
+    """
+    Count the stars with vsini >= threshold in every spectral class.
+    :param threshold: the vsini in km/s. This must be a multiple of VSINI_BIN_WIDTH
+    :return: dictionary of spectral class --> number of stars
+    """
+    if threshold % VSINI_BIN_WIDTH != 0:
+        raise ValueError('The vsini threshold must be a multiple of the {} km/s bin width'.format(VSINI_BIN_WIDTH))
+    return dict(session.query(Spectral_Class_Summary.spectral_class, func.sum(Spectral_Class_Summary.n_stars))
+                .filter(Spectral_Class_Summary.vsini_bin >= max(threshold, 0))
+                .group_by(Spectral_Class_Summary.spectral_class).all())
+
+
+def instrument_statistics(session):
+    """
+    :return: list of (instrument id, instrument name, n_observations, n_stars, n_spectra, n_ccfs) tuples.
+             Observations without an instrument have instrument id 0 and name None.
+    """
+    return session.query(Instrument_Summary.instrument_id, Instrument.name, Instrument_Summary.n_observations,
+                         Instrument_Summary.n_stars, Instrument_Summary.n_spectra, Instrument_Summary.n_ccfs) \
+        .outerjoin(Instrument, Instrument.id == Instrument_Summary.instrument_id) \
+        .order_by(Instrument_Summary.instrument_id).all()
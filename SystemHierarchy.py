@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+"""
+In-memory representation of the star system / configuration graph.
+
+Every configuration is treated as a directed edge from its primary
+(star_system1) to its secondary (star_system2) system, so a hierarchical
+triple or quadruple is a small tree of star systems. Walking that tree
+through the ORM relationships costs one lazy load per level and per system;
+the SystemGraph class below instead loads the configuration and
+star_to_star_system tables with one query each and stores them as
+compressed adjacency arrays, so that traversing the whole sample is O(edges).
+
+The ancestors_sql, descendants_sql and components_sql functions do the same walk inside the
+database with a recursive common table expression, for when only a handful
+of systems are needed and building the full graph is not worth it.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+from sqlalchemy import text
+
+from ModelClasses import Configuration, Star_to_Star_System
+
+
+def _csr(sources, targets, size):
+    """
+    Build a compressed sparse row adjacency structure.
+    :param sources: integer array of edge sources
+    :param targets: integer array of edge targets
+    :param size: number of nodes (the largest id + 1)
+    :return: (indptr, indices) such that the neighbours of node i are indices[indptr[i]:indptr[i+1]]
+    """
+    order = np.argsort(sources, kind='mergesort')
+    indices = targets[order]
+    counts = np.bincount(sources, minlength=size)
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, indices
+
+
+class SystemGraph():
+    def __init__(self, sql_session):
+        """
+        Load the whole system hierarchy into memory.
+        :param sql_session: a sqlalchemy session instance
+        """
+        edges = sql_session.query(Configuration.star_system1_id, Configuration.star_system2_id).all()
+        members = sql_session.query(Star_to_Star_System.star_system_id, Star_to_Star_System.star_id).all()
+
+        edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+        members = np.array(members, dtype=np.int64).reshape(-1, 2)
+
+        self.n_systems = int(max(edges.max() if edges.size else 0, members[:, 0].max() if members.size else 0)) + 1
+        self.n_stars = int(members[:, 1].max()) + 1 if members.size else 1
+
+        self._child_ptr, self._child_idx = _csr(edges[:, 0], edges[:, 1], self.n_systems)
+        self._parent_ptr, self._parent_idx = _csr(edges[:, 1], edges[:, 0], self.n_systems)
+        self._star_ptr, self._star_idx = _csr(members[:, 0], members[:, 1], self.n_systems)
+        self._system_ptr, self._system_idx = _csr(members[:, 1], members[:, 0], self.n_stars)
+
+    @staticmethod
+    def _neighbours(indptr, indices, node):
+        if node < 0 or node + 1 >= len(indptr):
+            return indices[:0]
+        return indices[indptr[node]:indptr[node + 1]]
+
+    def _walk(self, indptr, indices, system_id):
+        """
+        Breadth-first walk from system_id, not including system_id itself.
+        Cycles (which should not exist, but are not prevented by the schema) are only visited once.
+        """
+        visited = np.zeros(self.n_systems, dtype=bool)
+        frontier = np.array([system_id], dtype=np.int64)
+        found = []
+        while frontier.size > 0:
+            nxt = np.concatenate([self._neighbours(indptr, indices, s) for s in frontier])
+            nxt = np.unique(nxt[~visited[nxt]]) if nxt.size > 0 else nxt
+            visited[nxt] = True
+            found.append(nxt)
+            frontier = nxt
+        out = np.concatenate(found)
+        return out[out != system_id]
+
+    def children(self, system_id):
+        """
+        :return: array of the star system ids that are secondaries of this system
+        """
+        return self._neighbours(self._child_ptr, self._child_idx, system_id)
+
+    def parents(self, system_id):
+        """
+        :return: array of the star system ids that have this system as a secondary
+        """
+        return self._neighbours(self._parent_ptr, self._parent_idx, system_id)
+
+    def descendants(self, system_id):
+        """
+        :return: array of every star system id below this one in the hierarchy
+        """
+        return self._walk(self._child_ptr, self._child_idx, system_id)
+
+    def ancestors(self, system_id):
+        """
+        :return: array of every star system id above this one in the hierarchy
+        """
+        return self._walk(self._parent_ptr, self._parent_idx, system_id)
+
+    def stars(self, system_id):
+        """
+        :return: array of the star ids directly in this system
+        """
+        return self._neighbours(self._star_ptr, self._star_idx, system_id)
+
+    def systems_of_star(self, star_id):
+        """
+        :return: array of the star system ids that contain the given star
+        """
+        return self._neighbours(self._system_ptr, self._system_idx, star_id)
+
+    def components(self, system_id):
+        """
+        :return: sorted array of the ids of every star in this system or any system below it
+        """
+        systems = np.concatenate([[system_id], self.descendants(system_id)])
+        return np.unique(np.concatenate([self.stars(s) for s in systems]))
+
+    def roots(self):
+        """
+        :return: array of the star system ids that take part in a configuration and are nobody's secondary
+        """
+        has_children = np.diff(self._child_ptr) > 0
+        has_parents = np.diff(self._parent_ptr) > 0
+        return np.flatnonzero(has_children & ~has_parents)
+
+    def depth(self):
+        """
+        Hierarchy depth of every star system, in one pass over the edges.
+        :return: integer array indexed by star system id (0 for top-level systems)
+        """
+        depth = np.zeros(self.n_systems, dtype=np.int64)
+        indegree = np.diff(self._parent_ptr).copy()
+        frontier = np.flatnonzero(indegree == 0)
+        while frontier.size > 0:
+            nxt = []
+            for s in frontier:
+                kids = self.children(s)
+                depth[kids] = np.maximum(depth[kids], depth[s] + 1)
+                indegree[kids] -= 1
+                nxt.append(kids[indegree[kids] == 0])
+            frontier = np.unique(np.concatenate(nxt)) if len(nxt) > 0 else np.array([], dtype=np.int64)
+        return depth
+
+
+_DESCENDANTS_SQL = """
+WITH RECURSIVE below(id) AS (
+    SELECT star_system2_id FROM configuration WHERE star_system1_id = :system_id
+    UNION
+    SELECT c.star_system2_id FROM configuration c JOIN below b ON c.star_system1_id = b.id
+)
+SELECT id FROM below WHERE id != :system_id
+"""
+
+_ANCESTORS_SQL = """
+WITH RECURSIVE above(id) AS (
+    SELECT star_system1_id FROM configuration WHERE star_system2_id = :system_id
+    UNION
+    SELECT c.star_system1_id FROM configuration c JOIN above a ON c.star_system2_id = a.id
+)
+SELECT id FROM above WHERE id != :system_id
+"""
+
+_COMPONENTS_SQL = """
+WITH RECURSIVE below(id) AS (
+    SELECT :system_id
+    UNION
+    SELECT c.star_system2_id FROM configuration c JOIN below b ON c.star_system1_id = b.id
+)
+SELECT DISTINCT m.star_id FROM star_to_star_system m JOIN below b ON m.star_system_id = b.id
+ORDER BY m.star_id
+"""
+
+
+def descendants_sql(session, system_id):
+    """
+    Same as SystemGraph.descendants, but evaluated in the database with a recursive CTE.
+    """
+    return [row[0] for row in session.execute(text(_DESCENDANTS_SQL), {'system_id': system_id})]
+
+
+def ancestors_sql(session, system_id):
+    """
+    Same as SystemGraph.ancestors, but evaluated in the database with a recursive CTE.
+    """
+    return [row[0] for row in session.execute(text(_ANCESTORS_SQL), {'system_id': system_id})]
+
+
+def components_sql(session, system_id):
+    """
+    Same as SystemGraph.components, but evaluated in the database with a recursive CTE.
+    """
+    return [row[0] for row in session.execute(text(_COMPONENTS_SQL), {'system_id': system_id})]
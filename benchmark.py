@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+"""
+Benchmark the ingest and query hot paths against a synthetic catalog.
+
+Each run generates a deterministic fake star catalog (with SIMBAD-like
+bibcodes and a WDS/SB9-like multiplicity catalog) at every requested size,
+loads it into an empty database with the same ORM access patterns that
+fill_db.py uses, and times every stage. The timings are written as JSON so
+that runs from different versions can be compared.
+
+Usage:
+    python benchmark.py --db sqlite:///bench.sqlite --sizes 1000 10000 --output sqlite.json
+    python benchmark.py --db postgresql://localhost/stars_bench --sizes 1000 10000 100000 --output pg.json
+
+The target database is wiped and re-created from the schema of Stars.sqlite,
+so never point --db at a database you care about. Because DatabaseConnection
+is a singleton, each backend needs its own process.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import timeit
+
+import numpy as np
+import sqlalchemy
+from sqlalchemy import create_engine, MetaData
+
+from DatabaseConnection import DatabaseConnection
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The six reference fields that get_simbad_data resolves for every star
+REF_FIELDS = ['Vmag', 'Kmag', 'parallax', 'spectral_type', 'vsys', 'vsini']
+
+
+def make_catalog(n_stars, seed=42):
+    """
+    Generate a synthetic star catalog.
+    :param n_stars: the number of stars
+    :param seed: random seed, so the same catalog is made every time
+    :return: dictionary of numpy arrays, one per star column, plus the bibcode of every reference field
+    """
+    rs = np.random.RandomState(seed)
+    n_refs = max(10, n_stars // 20)
+    bibcodes = np.array(['{}A&A...{:03d}.{:04d}X'.format(1990 + i % 25, i % 1000, i) for i in range(n_refs)])
+    spt = np.array(['{}{}V'.format(c, i) for c in 'OBAFGKM' for i in range(10)])
+    catalog = {'name': np.array(['SYN {:07d}'.format(i) for i in range(n_stars)]),
+               'RA': rs.uniform(0, 24, n_stars),
+               'DEC': np.degrees(np.arcsin(rs.uniform(-1, 1, n_stars))),
+               'Vmag': rs.uniform(2, 12, n_stars),
+               'Vmag_error': rs.uniform(0.001, 0.05, n_stars),
+               'Kmag': rs.uniform(1, 11, n_stars),
+               'Kmag_error': rs.uniform(0.001, 0.05, n_stars),
+               'parallax': rs.uniform(1, 100, n_stars),
+               'parallax_error': rs.uniform(0.1, 2, n_stars),
+               'vsini': rs.uniform(0, 350, n_stars),
+               'vsini_error': rs.uniform(1, 20, n_stars),
+               'spectral_type': spt[rs.randint(0, len(spt), n_stars)],
+               'vsys': rs.normal(0, 20, n_stars),
+               'vsys_error': rs.uniform(0.1, 5, n_stars)}
+    for field in REF_FIELDS:
+        catalog['{}_bibcode'.format(field)] = bibcodes[rs.randint(0, n_refs, n_stars)]
+    return catalog
+
+
+def make_multiplicity_catalog(catalog, binary_fraction=0.3, n_field=None, seed=43):
+    """
+    Generate a synthetic multiplicity catalog: one entry close to a fraction of the catalog stars,
+    plus unrelated field entries.
+    :return: dictionary with RA (in degrees), DEC, separation and period arrays
+    """
+    rs = np.random.RandomState(seed)
+    n_stars = len(catalog['name'])
+    n_field = n_stars if n_field is None else n_field
+    idx = np.flatnonzero(rs.uniform(size=n_stars) < binary_fraction)
+    ra = np.concatenate([catalog['RA'][idx] * 15.0 + rs.normal(0, 1e-5, idx.size), rs.uniform(0, 360, n_field)])
+    dec = np.concatenate([catalog['DEC'][idx] + rs.normal(0, 1e-5, idx.size),
+                          np.degrees(np.arcsin(rs.uniform(-1, 1, n_field)))])
+    return {'RA': ra, 'DEC': dec,
+            'separation': rs.lognormal(0, 2, ra.size),
+            'period': rs.lognormal(5, 3, ra.size)}
+
+
+def make_schema(url):
+    """
+    (Re-)create every table in the target database, using Stars.sql for SQLite databases
+    and the reflected schema of Stars.sqlite for everything else.
+    """
+    engine = create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        with open(os.path.join(HERE, 'Stars.sql')) as infile:
+            schema = infile.read()
+        connection = engine.raw_connection()
+        connection.executescript(schema)
+        connection.commit()
+        connection.close()
+    else:
+        template = create_engine('sqlite:///{}'.format(os.path.join(HERE, 'Stars.sqlite')))
+        metadata = MetaData()
+        metadata.reflect(bind=template)
+        metadata.drop_all(bind=engine)
+        metadata.create_all(bind=engine)
+        template.dispose()
+    engine.dispose()
+
+
+def clear_tables(session):
+    """
+    Delete every row in the database, children first.
+    """
+    import ModelClasses
+
+    existing = sqlalchemy.inspect(session.get_bind()).get_table_names()
+    session.begin()
+    for table in reversed(ModelClasses.Base.metadata.sorted_tables):
+        if table.name in existing:
+            session.execute(table.delete())
+    session.commit()
+
+
+class Timer():
+    def __init__(self):
+        self.results = dict()
+
+    @contextlib.contextmanager
+    def __call__(self, stage, n):
+        """
+        Time the enclosed block.
+        :param stage: the name to record the timing under
+        :param n: the number of items processed in the block, used for the rate
+        """
+        start = timeit.default_timer()
+        yield
+        seconds = timeit.default_timer() - start
+        self.results[stage] = {'seconds': seconds, 'n': int(n), 'per_second': n / seconds if seconds > 0 else None}
+        print('  {:<24s} {:10.3f} s  ({} items)'.format(stage, seconds, n))
+
+
+def run_size(session, n_stars, max_crossmatch=10000, seed=42):
+    """
+    Run every benchmark stage on a synthetic catalog of the given size.
+    :param session: a sqlalchemy session on an empty database
+    :param n_stars: the number of stars to generate
+    :param max_crossmatch: the maximum number of stars to cross-match (cross-matching is O(stars * catalog))
+    :return: dictionary of stage --> timing
+    """
+    from ModelClasses import Star, Star_System, Configuration
+    from StarQueries import iter_stars, get_reference
+    from SystemHierarchy import SystemGraph
+
+    timer = Timer()
+    catalog = make_catalog(n_stars, seed=seed)
+    multiplicity = make_multiplicity_catalog(catalog, seed=seed + 1)
+
+    session.begin()
+
+    # Reference resolution: one get_reference call per reference field per star, as in get_simbad_data
+    refs = dict()
+    with timer('reference_resolution', n_stars * len(REF_FIELDS)):
+        for i in range(n_stars):
+            for field in REF_FIELDS:
+                bibcode = catalog['{}_bibcode'.format(field)][i]
+                refs[bibcode], session = get_reference(session, bibcode)
+
+    # Star ingest: existence check by name, then add and flush every star
+    with timer('star_ingest', n_stars):
+        for i in range(n_stars):
+            name = catalog['name'][i]
+            try:
+                session.query(Star).filter(Star.name == name).one()
+            except sqlalchemy.orm.exc.NoResultFound:
+                entry = Star()
+                entry.name = name
+                for column in ['RA', 'DEC', 'Vmag', 'Vmag_error', 'Kmag', 'Kmag_error', 'parallax',
+                               'parallax_error', 'vsini', 'vsini_error', 'vsys', 'vsys_error']:
+                    setattr(entry, column, float(catalog[column][i]))
+                entry.spectral_type = catalog['spectral_type'][i]
+                for field in REF_FIELDS:
+                    setattr(entry, '{}_ref'.format(field), refs[catalog['{}_bibcode'.format(field)][i]])
+                session.add(entry)
+                session.flush()
+    session.commit()
+    session.expunge_all()
+
+    # Star system creation, as in make_star_systems
+    session.begin()
+    with timer('star_system_creation', n_stars):
+        for star in iter_stars(session):
+            try:
+                session.query(Star_System).filter(Star_System.stars.contains(star)).one()
+            except sqlalchemy.orm.exc.NoResultFound:
+                ss = Star_System()
+                ss.stars.append(star)
+                session.add(ss)
+                session.flush()
+    session.commit()
+    session.expunge_all()
+
+    # Cross-match against the multiplicity catalog, as in check_multiplicity
+    d = (1.0 / 3600.0)
+    n_match = min(n_stars, max_crossmatch)
+    matches = []
+    with timer('cross_match', n_match):
+        for star_id, ra, dec in iter_stars(session, columns=['RA', 'DEC']):
+            if len(matches) >= n_match:
+                break
+            good = ((multiplicity['RA'] - ra * 15.0)**2 < d) & ((multiplicity['DEC'] - dec)**2 < d)
+            matches.append((star_id, np.flatnonzero(good)))
+
+    # Configurations for the matched binaries: pair every matched star system with a new companion system
+    session.begin()
+    n_binaries = sum(1 for _, m in matches if m.size > 0)
+    with timer('configuration_creation', n_binaries):
+        for star_id, m in matches:
+            if m.size == 0:
+                continue
+            primary = session.query(Star_System).filter(Star_System.stars.any(Star.id == star_id)).first()
+            secondary = Star_System()
+            session.add(secondary)
+            conf = Configuration()
+            conf.primary = primary
+            conf.secondary = secondary
+            conf.separation = float(multiplicity['separation'][m[0]])
+            conf.period = float(multiplicity['period'][m[0]])
+            session.add(conf)
+        session.flush()
+    session.commit()
+    session.expunge_all()
+
+    # Relationship loading: touch the lazy-loaded relationships of every star (the N+1 pattern)
+    with timer('relationship_loading', n_stars):
+        for star in iter_stars(session):
+            star.vsini_ref
+            star.spectral_type_ref
+            star.cluster
+            star.systems
+    session.expunge_all()
+
+    with timer('system_graph', n_stars):
+        graph = SystemGraph(session)
+        graph.depth()
+
+    # Export: every star column into a numpy structured array, then to disk
+    columns = [c.name for c in Star.__table__.columns if c.name != 'id']
+    with timer('export', n_stars):
+        rows = list(iter_stars(session, chunk_size=10000, columns=columns))
+        dtype = [('id', 'i8')] + [(c, 'O') for c in columns]
+        table = np.array(rows, dtype=dtype)
+        with tempfile.TemporaryFile() as outfile:
+            np.save(outfile, table, allow_pickle=True)
+
+    return timer.results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(url, sizes, output, max_crossmatch=10000):
+    make_schema(url)
+    db = DatabaseConnection(database_connection_string=url)
+    Session = db.Session
+
+    report = {'database': db.engine.dialect.name,
+              'url': repr(db.engine.url),
+              'date': datetime.datetime.utcnow().isoformat(),
+              'git_revision': git_revision(),
+              'python': platform.python_version(),
+              'sqlalchemy': sqlalchemy.__version__,
+              'numpy': np.__version__,
+              'sqlite': sqlite3.sqlite_version,
+              'results': dict()}
+
+    for n_stars in sizes:
+        print('{} stars:'.format(n_stars))
+        session = Session()
+        clear_tables(session)
+        report['results'][str(n_stars)] = run_size(session, n_stars, max_crossmatch=max_crossmatch)
+        session.close()
+
+    with open(output, 'w') as outfile:
+        json.dump(report, outfile, indent=2, sort_keys=True)
+    db.engine.dispose()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ingest and query hot paths.')
+    parser.add_argument('--db', default='sqlite:///{}'.format(os.path.join(tempfile.gettempdir(), 'Stars_bench.sqlite')),
+                        help='SQLAlchemy connection string of a scratch database (it will be wiped!)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='Catalog sizes to benchmark (e.g. 1000 10000 100000 1000000)')
+    parser.add_argument('--max-crossmatch', type=int, default=10000,
+                        help='Maximum number of stars to cross-match per size')
+    parser.add_argument('--output', default='benchmark.json', help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    main(args.db, args.sizes, args.output, max_crossmatch=args.max_crossmatch)
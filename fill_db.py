@@ -18,25 +18,17 @@ import SpectralTypeRelations
 
 from SQLiteConnection import engine, Session
 from ModelClasses import *
+from StarQueries import iter_stars, get_reference, get_references, match_catalog, \
+    create_alias_table, add_aliases, add_star_names, resolve_names
+from Instrumentation import profiler
+from Summaries import create_summary_tables, refresh_summaries, track_sessions
+from Maintenance import track_changes, maintain_if_changed
 
 
 MS = SpectralTypeRelations.MainSequence()
 
-def get_reference(session, bibcode):
-    """
-    Return a reference object for the specified bibcode
-    """
-    try:
-        entry = session.query(Reference).filter(Reference.bibcode == bibcode).one()
-    except sqlalchemy.orm.exc.NoResultFound:
-        entry = Reference()
-        entry.bibcode = bibcode
-        session.add(entry)
-        session.flush()
-
-        #TODO: get author name, journal, volume, page, and year
-    return entry, session
-
+# Record what every flush changes, so the summary tables can be refreshed incrementally
+track_sessions(Session)
 
 class StellarParameter():
     def __init__(self, sql_session):
@@ -57,7 +49,8 @@ class StellarParameter():
         except sqlalchemy.orm.exc.NoResultFound:
             raise ValueError('Must put star in database before giving it parameters!')
 
-        output = self.pastel.query_object(starname)
+        with profiler.stage('pastel.query_object'):
+            output = self.pastel.query_object(starname)
         if len(output) == 0:
             logging.warn('No match for star {} in Pastel catalog'.format(starname))
             return False
@@ -95,7 +88,7 @@ class StellarParameter():
         """
         success = []
         fail = []
-        for star in self.sql_session.query(Star).all():
+        for star in iter_stars(self.sql_session):
             print(star.name)
             out = self.get_pastel_pars(star.name)
             if out:
@@ -105,15 +98,89 @@ class StellarParameter():
         logging.info('Of all stars in the database, we got stellar parameters for {} of them'.format(len(success)))
         return
 
+    def get_pastel_table(self):
+        """
+        Download the whole PASTEL catalog (with the same columns as the per-star queries, and the
+          computed J2000 positions for matching)
+        """
+        columns = ['_RAJ2000', '_DEJ2000'] + [c for c in self.pastel.columns if c not in ('_RAJ2000', 'DEJ2000')]
+        vizier = Vizier(columns=columns, catalog='B/pastel/pastel', row_limit=-1)
+        with profiler.stage('pastel.get_catalogs'):
+            return vizier.get_catalogs('B/pastel/pastel')[0]
+
+    def get_all_pars_bulk(self, table=None, chunk_size=500, tolerance=2.0):
+        """
+        Fill the PASTEL parameters for every star at once. The catalog is matched to the stars by
+          identifier through the alias table, and otherwise by position (see match_catalog), and the
+          values are written with one executemany UPDATE per chunk of stars.
+        :param table: the PASTEL catalog, as an astropy table. Downloaded with get_pastel_table if not given.
+        :param chunk_size: the number of stars to update per statement
+        :param tolerance: the largest separation for a match by position, in arcsec
+        :return: the number of stars that were updated
+        """
+        if table is None:
+            table = self.get_pastel_table()
+
+        # (database column, catalog column, catalog error column, reference column)
+        pars = [('temperature', 'Teff', 'e_Teff', 'temperature_ref_id'),
+                ('logg', 'logg', 'e_logg', 'logg_ref_id'),
+                ('metallicity', '__Fe_H_', 'e__Fe_H_', 'metallicity_ref_id')]
+        columns = dict()
+        for db_col, value_col, error_col, _ in pars:
+            for name, col in [(db_col, value_col), ('{}_error'.format(db_col), error_col)]:
+                columns[name] = (np.ma.getdata(table[col]), np.ma.getmaskarray(table[col]))
+
+        # star id --> catalog row
+        rows = match_catalog(self.sql_session, names=table['ID'], ra=table['_RAJ2000'], dec=table['_DEJ2000'],
+                             tolerance=tolerance)
+        if len(rows) == 0:
+            logging.warn('No stars in the database matched the PASTEL catalog')
+            return 0
+
+        bibcodes = [str(b).strip() for b in table['bibcode']]
+        bibcodes = [b if len(b) > 0 else 'Unknown' for b in bibcodes]
+        ref_ids = get_references(self.sql_session, [bibcodes[i] for i in rows.values()])
+
+        # Masked values are passed as NULL, and leave the current value (and its reference) alone
+        star_table = Star.__table__
+        values = dict()
+        for db_col, _, _, ref_col in pars:
+            error_col = '{}_error'.format(db_col)
+            values[db_col] = sqlalchemy.func.coalesce(sqlalchemy.bindparam('b_{}'.format(db_col)),
+                                                      star_table.c[db_col])
+            values[error_col] = sqlalchemy.func.coalesce(sqlalchemy.bindparam('b_{}'.format(error_col)),
+                                                         star_table.c[error_col])
+            values[ref_col] = sqlalchemy.case([(sqlalchemy.bindparam('b_{}'.format(db_col)).is_(None),
+                                                star_table.c[ref_col])],
+                                              else_=sqlalchemy.bindparam('b_ref_id'))
+        statement = star_table.update().where(star_table.c.id == sqlalchemy.bindparam('b_id')).values(values)
+
+        params = []
+        for star_id, i in rows.items():
+            p = {'b_id': star_id, 'b_ref_id': ref_ids[bibcodes[i]]}
+            for name, (data, mask) in columns.items():
+                p['b_{}'.format(name)] = None if mask[i] else float(data[i])
+            params.append(p)
+
+        self.sql_session.flush()
+        for i in range(0, len(params), chunk_size):
+            self.sql_session.execute(statement, params[i:i + chunk_size])
+        # Loaded Star objects no longer match the database
+        self.sql_session.expire_all()
+
+        logging.info('Got PASTEL stellar parameters for {} of the stars in the database'.format(len(params)))
+        return len(params)
+
 
 
 class Multiplicity():
     def __init__(self, sql_session,
                  csv_dir='{}/Dropbox/School/Research/Databases/A_star/Multiplicity/'.format(os.environ['HOME'])):
-        self.sb9 = pd.read_csv('{}SB9_WithNames.txt'.format(csv_dir), sep='|')
-        self.wds = pd.read_csv('{}WDS_WithNames.txt'.format(csv_dir), sep='|')
-        self.vast = pd.read_csv('{}VAST_WithNames.txt'.format(csv_dir), sep='|')
-        self.et08 = pd.read_csv('{}ET2008_WithNames.txt'.format(csv_dir), sep='|')
+        with profiler.stage('multiplicity.read_catalogs'):
+            self.sb9 = pd.read_csv('{}SB9_WithNames.txt'.format(csv_dir), sep='|')
+            self.wds = pd.read_csv('{}WDS_WithNames.txt'.format(csv_dir), sep='|')
+            self.vast = pd.read_csv('{}VAST_WithNames.txt'.format(csv_dir), sep='|')
+            self.et08 = pd.read_csv('{}ET2008_WithNames.txt'.format(csv_dir), sep='|')
 
         # Convert the DEC to the appropriate format in WDS
         self.wds = self.wds.dropna(subset=['RA', 'DEC'])
@@ -140,7 +207,7 @@ class Multiplicity():
         :keyword d: The on-sky distance between the database star and the entry in the multiplicity databases (in arcsec)
         """
         d /= 3600.0  #Convert d to degrees
-        for star in self.sql_session.query(Star).all():
+        for star in iter_stars(self.sql_session):
             print('\n\n', star.name)
             ra = star.RA * 15.0
             dec = star.DEC
@@ -332,6 +399,7 @@ class Multiplicity():
 
 
 
+@profiler.timed()
 def get_simbad_data(session, starlist_filename='starlist.dat'):
     # Read in the star list
     infile = open(starlist_filename)
@@ -345,16 +413,27 @@ def get_simbad_data(session, starlist_filename='starlist.dat'):
                            'rot',
                            'sp', 'sp_bibcode',
                            'plx', 'plx_error', 'plx_bibcode',
-                           'rvel', 'rvz_bibcode', 'rvz_error', 'rvz_radvel', 'rvz_type')
+                           'rvel', 'rvz_bibcode', 'rvz_error', 'rvz_radvel', 'rvz_type',
+                           'ids')
+
+    # Resolve as many names as possible locally, so we only go to Simbad for new stars
+    add_star_names(session)
+    known = resolve_names(session, [s for s in starlist if len(s.strip()) > 0])
 
     # loop over the files
     for starname in starlist:
+        if known.get(starname) is not None:
+            print('Star ({}) already in database! Skipping...'.format(starname.strip()))
+            continue
+
         # Get data from the Simbad database
-        star = sim.query_object(starname)
+        with profiler.stage('simbad.query_object'):
+            star = sim.query_object(starname)
         print(starname)
 
         test_aq = lambda key, default=None: star[key].item() if not star[key].mask else default
         name = test_aq('MAIN_ID')
+        ids = test_aq('IDS', default='')
         ra = HelperFunctions.convert_hex_string(star['RA'].item(), delimiter=' ')
         dec = HelperFunctions.convert_hex_string(star['DEC'].item(), delimiter=' ')
         Vmag = test_aq('FLUX_V')
@@ -391,6 +470,7 @@ def get_simbad_data(session, starlist_filename='starlist.dat'):
         try:
             entry = session.query(Star).filter(Star.name == name).one()
             print('Star ({}) already in database! Skipping...'.format(starname))
+            add_aliases(session, entry.id, [starname] + ids.split('|'))
         except sqlalchemy.orm.exc.NoResultFound:
             entry = Star()
             entry.name = None if (isinstance(name, str) and name.strip() == '') else name
@@ -416,22 +496,34 @@ def get_simbad_data(session, starlist_filename='starlist.dat'):
 
             session.add(entry)
             session.flush()
+            add_aliases(session, entry.id, [name, starname] + ids.split('|'))
 
+    refresh_summaries(session)
     return session
 
 
-def add_stellar_parameters(session):
+@profiler.timed()
+def add_stellar_parameters(session, bulk=False):
+    """
+    Fill the PASTEL parameters star by star. With bulk=True, the whole catalog is downloaded and
+      matched to the stars at once instead (see StellarParameter.get_all_pars_bulk).
+    """
     SP = StellarParameter(session)
-    SP.get_all_pars()
+    if bulk:
+        SP.get_all_pars_bulk()
+    else:
+        SP.get_all_pars()
+    refresh_summaries(SP.sql_session)
     return SP.sql_session
 
 
 
+@profiler.timed()
 def make_star_systems(session):
     """
     Make a star system for every star
     """
-    for star in session.query(Star).all():
+    for star in iter_stars(session):
         print(star.name)
         try:
             ss = session.query(Star_System).filter(Star_System.stars.contains(star)).one()
@@ -444,8 +536,10 @@ def make_star_systems(session):
             session.add(ss)
             session.flush()
 
+    refresh_summaries(session)
     return session
 
+@profiler.timed()
 def add_multiplicity(session):
     mult = Multiplicity(session)
     mult.check_multiplicity()
@@ -455,6 +549,10 @@ def add_multiplicity(session):
 
 
 if __name__ == '__main__':
+    profiler.attach(engine)
+    track_changes(engine)
+    create_alias_table(engine)
+    create_summary_tables(engine)
     session = Session()
     session.begin()
     #session = get_simbad_data(session)
@@ -462,8 +560,13 @@ if __name__ == '__main__':
     #session = make_star_systems(session)
     add_multiplicity(session)
 
+    refresh_summaries(session)
     session.commit()
     engine.dispose()
+    maintain_if_changed(engine)
+
+    print(profiler.summary())
+    profiler.write('fill_db_metrics.json')
 
 
 """ ===========================================
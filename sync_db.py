@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+"""
+Copy, compare or synchronize the star database between two backends
+(typically a local SQLite file and the shared PostgreSQL database).
+
+Usage:
+    python sync_db.py copy sqlite:///Stars.sqlite postgresql://localhost/stars
+    python sync_db.py diff postgresql://localhost/stars sqlite:///Stars.sqlite
+    python sync_db.py sync postgresql://localhost/stars sqlite:///Stars.sqlite --delete
+
+copy   replaces every row in the target with the rows in the source.
+diff   reports how many rows would be inserted, updated and deleted by a sync.
+sync   applies only the differences: rows are streamed from both databases in
+       primary key order and merged, so only new and changed rows are written
+       (and rows missing from the source deleted, with --delete).
+
+Ids are preserved, tables are processed in foreign key order (and deletes in
+reverse order), and tables that do not exist in the target are created from
+the source schema. Writes to PostgreSQL use COPY; writes to SQLite use one
+executemany per chunk inside a single transaction.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import sys
+
+from sqlalchemy import create_engine, MetaData, select, and_, bindparam, text
+
+from Maintenance import record_changes
+
+
+def reflect(engine, tables=None):
+    """
+    :return: the MetaData of every table (except the internal SQLite ones) in the database
+    """
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=lambda name, _: not name.startswith('sqlite_') and
+                     (tables is None or name in tables))
+    return metadata
+
+
+def _primary_key(table):
+    pk = list(table.primary_key.columns)
+    return pk if len(pk) > 0 else list(table.columns)
+
+
+def stream_rows(connection, table, columns, chunk_size=10000):
+    """
+    Yield every row of a table as a tuple of the given columns, in primary key order.
+    """
+    pk = [table.c[c.name] for c in _primary_key(table)]
+    statement = select([table.c[name] for name in columns]).order_by(*pk)
+    result = connection.execution_options(stream_results=True).execute(statement)
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            yield tuple(row)
+    result.close()
+
+
+def diff_rows(source_rows, target_rows, key_index):
+    """
+    Merge two streams of rows sorted by primary key.
+    :param key_index: the positions of the primary key columns in each row
+    :return: generator of ('insert', row), ('update', row) and ('delete', row) tuples
+    """
+    key = lambda row: tuple(row[i] for i in key_index)
+    source_row = next(source_rows, None)
+    target_row = next(target_rows, None)
+    while source_row is not None or target_row is not None:
+        if target_row is None or (source_row is not None and key(source_row) < key(target_row)):
+            yield 'insert', source_row
+            source_row = next(source_rows, None)
+        elif source_row is None or key(target_row) < key(source_row):
+            yield 'delete', target_row
+            target_row = next(target_rows, None)
+        else:
+            if source_row != target_row:
+                yield 'update', source_row
+            source_row = next(source_rows, None)
+            target_row = next(target_rows, None)
+
+
+def _csv_field(value):
+    """
+    Format one value for COPY ... (FORMAT csv, NULL '\\N'): NULL is an unquoted \\N, and
+    every string is quoted, so '' and '\\N' stay strings.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, float) and value != value:
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (bool, int)):
+        return str(value)
+    return '"{}"'.format(('{}'.format(value)).replace('"', '""'))
+
+
+def bulk_insert(connection, table, columns, rows):
+    """
+    Insert rows (tuples of the given columns) with the fastest method the backend has.
+    """
+    if len(rows) == 0:
+        return
+    if connection.dialect.name == 'postgresql':
+        buf = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        for row in rows:
+            line = ','.join(_csv_field(v) for v in row) + '\n'
+            buf.write(line if sys.version_info[0] >= 3 else line.encode('utf-8'))
+        buf.seek(0)
+        names = ', '.join('"{}"'.format(c) for c in columns)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert("COPY \"{}\" ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table.name, names), buf)
+        # COPY goes around the engine's cursor events
+        record_changes(connection.engine, len(rows))
+    else:
+        connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def bulk_update(connection, table, columns, rows):
+    """
+    Update rows (tuples of the given columns) by primary key with one executemany.
+    """
+    pk = set(c.name for c in _primary_key(table))
+    values = [c for c in columns if c not in pk]
+    if len(rows) == 0 or len(values) == 0:
+        return
+    statement = table.update().where(and_(*[table.c[c] == bindparam('pk_{}'.format(c)) for c in pk])) \
+        .values(dict((c, bindparam('v_{}'.format(c))) for c in values))
+    params = []
+    for row in rows:
+        p = dict(('v_{}'.format(c), v) for c, v in zip(columns, row) if c in values)
+        p.update(dict(('pk_{}'.format(c), v) for c, v in zip(columns, row) if c in pk))
+        params.append(p)
+    connection.execute(statement, params)
+
+
+def bulk_delete(connection, table, columns, rows):
+    """
+    Delete rows (tuples of the given columns) by primary key.
+    """
+    if len(rows) == 0:
+        return
+    pk = [c.name for c in _primary_key(table)]
+    idx = [columns.index(c) for c in pk]
+    if len(pk) == 1:
+        connection.execute(table.delete().where(table.c[pk[0]].in_([row[idx[0]] for row in rows])))
+    else:
+        statement = table.delete().where(and_(*[table.c[c] == bindparam('pk_{}'.format(c)) for c in pk]))
+        connection.execute(statement, [dict(('pk_{}'.format(c), row[i]) for c, i in zip(pk, idx)) for row in rows])
+
+
+def reset_sequences(connection, table):
+    """
+    Move the PostgreSQL id sequence of a table past the largest copied id.
+    """
+    pk = _primary_key(table)
+    if connection.dialect.name != 'postgresql' or len(pk) != 1:
+        return
+    connection.execute(text("SELECT setval(pg_get_serial_sequence('\"{t}\"', '{c}'), "
+                            "COALESCE(MAX(\"{c}\"), 1)) FROM \"{t}\"".format(t=table.name, c=pk[0].name)))
+
+
+def sync(source_url, target_url, mode='sync', delete=False, tables=None, chunk_size=10000):
+    """
+    Copy, diff or sync every table from the source database to the target database.
+    :param target_url: the connection string of the target database, or an engine on it
+                       (e.g. one whose writes are counted with Maintenance.track_changes)
+    :param mode: 'copy', 'diff' or 'sync'
+    :param delete: in sync mode, delete target rows that are not in the source
+    :param tables: optional list of table names to process (default: all of them)
+    :return: dictionary of table name --> {'insert': n, 'update': n, 'delete': n}
+    """
+    source = create_engine(source_url)
+    target = target_url if hasattr(target_url, 'dialect') else create_engine(target_url)
+    source_meta = reflect(source, tables)
+    if mode != 'diff':
+        source_meta.create_all(bind=target, checkfirst=True)
+    target_meta = reflect(target, list(source_meta.tables))
+
+    counts = dict()
+    source_conn = source.connect()
+    target_conn = target.connect()
+    transaction = target_conn.begin()
+    try:
+        ordered = [t for t in source_meta.sorted_tables if t.name in target_meta.tables]
+        if mode == 'copy':
+            for table in reversed(ordered):
+                target_conn.execute(target_meta.tables[table.name].delete())
+
+        pending_deletes = []
+        for table in ordered:
+            target_table = target_meta.tables[table.name]
+            columns = [c.name for c in table.columns if c.name in target_table.c]
+            key_index = [columns.index(c.name) for c in _primary_key(table)]
+            counts[table.name] = {'insert': 0, 'update': 0, 'delete': 0}
+            source_rows = stream_rows(source_conn, table, columns, chunk_size)
+            if mode == 'copy':
+                changes = (('insert', row) for row in source_rows)
+            else:
+                changes = diff_rows(source_rows, stream_rows(target_conn, target_table, columns, chunk_size),
+                                    key_index)
+
+            buffers = {'insert': [], 'update': [], 'delete': []}
+            for action, row in changes:
+                counts[table.name][action] += 1
+                if mode == 'diff' or (action == 'delete' and not delete):
+                    continue
+                buffers[action].append(row)
+                if len(buffers['insert']) >= chunk_size:
+                    bulk_insert(target_conn, target_table, columns, buffers['insert'])
+                    buffers['insert'] = []
+                if len(buffers['update']) >= chunk_size:
+                    bulk_update(target_conn, target_table, columns, buffers['update'])
+                    buffers['update'] = []
+            bulk_insert(target_conn, target_table, columns, buffers['insert'])
+            bulk_update(target_conn, target_table, columns, buffers['update'])
+            pending_deletes.append((target_table, columns, buffers['delete']))
+            if mode != 'diff':
+                reset_sequences(target_conn, target_table)
+            print('{:<24s} {:>8d} inserted {:>8d} updated {:>8d} {}'.format(
+                table.name, counts[table.name]['insert'], counts[table.name]['update'],
+                counts[table.name]['delete'], 'deleted' if delete and mode == 'sync' else 'only in target'))
+
+        # Children first, so that no foreign key is left dangling
+        for target_table, columns, rows in reversed(pending_deletes):
+            for i in range(0, len(rows), chunk_size):
+                bulk_delete(target_conn, target_table, columns, rows[i:i + chunk_size])
+
+        if mode == 'diff':
+            transaction.rollback()
+        else:
+            transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        source_conn.close()
+        target_conn.close()
+        source.dispose()
+        target.dispose()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy, diff or sync the star database between two backends.')
+    parser.add_argument('mode', choices=['copy', 'diff', 'sync'])
+    parser.add_argument('source', help='SQLAlchemy connection string of the source database')
+    parser.add_argument('target', help='SQLAlchemy connection string of the target database')
+    parser.add_argument('--delete', action='store_true', help='In sync mode, delete rows missing from the source')
+    parser.add_argument('--tables', nargs='+', help='Only process these tables')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Rows per read and per write')
+    args = parser.parse_args()
+
+    sync(args.source, args.target, mode=args.mode, delete=args.delete, tables=args.tables, chunk_size=args.chunk_size)
@@ -0,0 +1,16 @@
+"""
+The modules connect to Stars.sqlite in the working directory when they are first imported,
+so the tests run in a temporary directory with copies of the database files.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='stardb_tests_')
+for filename in ('Stars.sqlite', 'Stars_ffplugin.sqlite'):
+    shutil.copy(os.path.join(REPO, filename), WORKDIR)
+os.chdir(WORKDIR)
+sys.path.insert(0, REPO)
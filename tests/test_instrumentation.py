@@ -0,0 +1,23 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from Instrumentation import Profiler
+
+
+def test_failed_statement_leaves_no_start_time():
+    engine = create_engine('sqlite://')
+    profiler = Profiler()
+    profiler.attach(engine)
+    try:
+        connection = engine.connect()
+        with pytest.raises(OperationalError):
+            connection.execute(text('SELECT * FROM no_such_table'))
+        assert connection.execute(text('SELECT 1')).scalar() == 1
+        assert connection.info['profiler_start_time'] == []
+        assert profiler.statements['SELECT 1'].count == 1
+        assert 'SELECT * FROM no_such_table' not in profiler.statements
+        connection.close()
+    finally:
+        profiler.detach()
+        engine.dispose()
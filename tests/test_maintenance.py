@@ -0,0 +1,25 @@
+import os
+import shutil
+
+from sqlalchemy import create_engine, text
+
+from Maintenance import track_changes, changed_rows, record_changes
+
+
+def test_raw_sql_writes_are_counted():
+    shutil.copy('Stars.sqlite', 'Stars_maintenance.sqlite')
+    engine = create_engine('sqlite:///Stars_maintenance.sqlite')
+    try:
+        track_changes(engine)
+        n_stars = engine.execute(text('SELECT COUNT(*) FROM star')).scalar()
+        engine.execute(text('CREATE TABLE star_copy AS SELECT * FROM star WHERE 0'))
+        engine.execute(text('INSERT INTO star_copy SELECT * FROM star'))
+        engine.execute('  update star_copy SET vsini = 1 WHERE id <= 10')
+        engine.execute(text('SELECT * FROM star_copy')).fetchall()
+        assert changed_rows(engine) == n_stars + 10
+
+        record_changes(engine, 5)
+        assert changed_rows(engine) == n_stars + 15
+    finally:
+        engine.dispose()
+        os.remove('Stars_maintenance.sqlite')
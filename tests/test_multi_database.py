@@ -0,0 +1,23 @@
+import sqlite3
+
+from MultiDatabase import create_unified_views
+
+
+def test_views_have_the_columns_of_every_file():
+    con = sqlite3.connect('Stars.sqlite')
+    con.execute("ATTACH DATABASE 'Stars_ffplugin.sqlite' AS ff")
+    # The older schema of Stars_ffplugin.sqlite has no star names, and a Reference table without bibcodes
+    con.execute("INSERT INTO ff.star (spectral_type) VALUES ('A0V')")
+    con.execute("INSERT INTO ff.Reference (first_author) VALUES ('Smith')")
+    create_unified_views(con, ['ff'])
+
+    n_main = con.execute('SELECT COUNT(*) FROM main.star').fetchone()[0]
+    rows = dict(con.execute('SELECT source_db, COUNT(name) FROM all_star GROUP BY source_db').fetchall())
+    assert rows == {'main': n_main, 'ff': 0}
+    assert con.execute("SELECT source_db, id FROM all_star WHERE name = 'HR  1092'").fetchall() == [('main', 1)]
+
+    columns = [r[1] for r in con.execute('PRAGMA table_info(all_reference)')]
+    assert 'bibcode' in columns and 'first_author' in columns
+    assert con.execute("SELECT bibcode FROM all_reference WHERE source_db = 'ff'").fetchall() == [(None,)]
+    con.rollback()
+    con.close()
@@ -0,0 +1,42 @@
+import pytest
+
+from SQLiteConnection import Session
+from StarQueries import add_aliases, add_star_names, resolve_names, match_catalog
+
+
+@pytest.fixture
+def session():
+    session = Session()
+    session.begin()
+    yield session
+    session.rollback()
+    Session.remove()
+
+
+def test_aliases_without_alias_table(session):
+    # The shipped Stars.sqlite has no star_alias table
+    assert resolve_names(session, ['HR 1092']) == {'HR 1092': None}
+    assert add_star_names(session) == session.execute('SELECT COUNT(*) FROM star').scalar()
+    assert add_aliases(session, 1, ['HD  22203', 'HR 1092']) == 1
+    assert resolve_names(session, ['hd 22203', 'HR 1092', 'HD 1']) == {'hd 22203': 1, 'HR 1092': 1, 'HD 1': None}
+
+
+def test_match_catalog_with_main_id_names(session):
+    # Stars are named by their SIMBAD main id, which catalogs such as PASTEL do not use
+    stars = dict(session.execute("SELECT name, id FROM star WHERE name IN ('HR  1092', '* sig For')").fetchall())
+    positions = dict((star_id, (ra * 15, dec)) for star_id, ra, dec in
+                     session.execute('SELECT id, RA, DEC FROM star WHERE id IN (:a, :b)',
+                                     {'a': stars['HR  1092'], 'b': stars['* sig For']}))
+    hr1092, sig_for = positions[stars['HR  1092']], positions[stars['* sig For']]
+    names = ['HD 99999', 'HD 22203', 'HD 17793', 'BD+00 0001']
+    ra = [0.0, hr1092[0] + 0.5 / 3600, sig_for[0], sig_for[0] + 0.2]
+    dec = [0.0, hr1092[1], sig_for[1] - 0.3 / 3600, sig_for[1]]
+
+    assert session.execute("SELECT COUNT(*) FROM star WHERE name LIKE 'HD%'").scalar() < 20
+    matches = match_catalog(session, names=names, ra=ra, dec=dec)
+    assert matches == {stars['HR  1092']: 1, stars['* sig For']: 2}
+
+    # A match by identifier wins over the position
+    add_aliases(session, stars['* sig For'], ['BD+00 0001'])
+    assert match_catalog(session, names=names, ra=ra, dec=dec)[stars['* sig For']] == 3
+    assert match_catalog(session, names=names) == {stars['* sig For']: 3}
@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from SQLiteConnection import Session
+from ModelClasses import Star
+import Summaries
+
+
+@pytest.fixture
+def session():
+    session = Session()
+    session.begin()
+    yield session
+    session.rollback()
+    Session.remove()
+
+
+def test_flush_new_star_with_minimum_fields(session):
+    Summaries.track_sessions(Session)
+    session.add(Star(name='B', spectral_type='B9V'))
+    session.flush()
+    assert 'B' in Summaries._pending['spectral_class']
+    assert 0 in Summaries._pending['cluster']
+
+
+def test_failed_flush_does_not_hide_core_writes(session):
+    Summaries.track_sessions(Session)
+    session.add(Star(id=1, name='B'))   # the id is already taken
+    with pytest.raises(IntegrityError):
+        session.flush()
+    session.rollback()
+    Summaries._stale.clear()
+
+    session.begin()
+    session.execute(Star.__table__.update().where(Star.__table__.c.id == 1).values(vsini=1.0))
+    assert 'spectral_class' in Summaries._stale
+
+
+def test_refresh_creates_missing_tables(session):
+    connection = session.connection()
+    assert not connection.dialect.has_table(connection, 'cluster_summary')
+    report = Summaries.refresh_summaries(session)
+    assert report == {'cluster': 'full', 'spectral_class': 'full', 'instrument': 'full'}
+    n_stars = session.execute('SELECT COUNT(*) FROM star').scalar()
+    assert sum(n for _, _, n, _, _ in Summaries.cluster_statistics(session)) == n_stars